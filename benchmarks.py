@@ -0,0 +1,269 @@
+#! /usr/bin/env python3
+"""Benchmark the composition pipeline on synthetic inputs.
+
+Everything runs against a fake `$MESA_DIR` in a temporary directory: a chain
+of nets that include each other, and a wide net of 500 isotopes. Timings
+(median and minimum of several runs; comparisons use the minimum) and peak memory (from tracemalloc, in a
+separate run) are recorded for `isos_from_net`, `blend_comps`,
+`alternate_iso`, and `make_composition_file`.
+
+To save a baseline and later check for regressions, run:
+
+    python benchmarks.py --save baseline.json
+    python benchmarks.py --compare baseline.json [--threshold 0.25]
+
+The comparison exits with status 1 if any benchmark got slower than the
+baseline by more than the threshold (a fraction; 0.25 is 25% slower).
+`--only NAME` (which can be repeated) runs just the benchmarks of a function,
+like `--only blend_comps`, or a single one, like
+`--only 'alternate_iso[zones=100]'`.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from os.path import join
+
+import numpy as np
+
+INCLUDE_DEPTH = 25
+WIDE_NET_SIZE = 500
+ZONES = [10**2, 10**3, 10**4, 10**5, 10**6]
+QUICK_ZONES = [10**2, 10**3, 10**4]
+# the text files grow as zones x isotopes, so writes use fewer zones
+WRITE_ZONES = [10**2, 10**3, 10**4, 10**5]
+WIDE_WRITE_ZONES = [10**2, 10**3, 10**4]
+
+def synthetic_isotopes(count):
+    """Return `count` plausible isotope names, sorted by (Z, A)."""
+    from list_isos import ATOMIC_SYMBOLS
+    isos = ['neut']
+    for z, symbol in enumerate(ATOMIC_SYMBOLS[1:], start=1):
+        isos.extend(f"{symbol}{a}" for a in range(z, 2 * z + 13))
+        if len(isos) >= count:
+            break
+    return isos[:count]
+
+def make_fake_mesa(root):
+    """Write synthetic nets under `root/data/net_data/nets`.
+
+    Creates `chain_0.net`, which includes `chain_1.net` and so on down to
+    `chain_<INCLUDE_DEPTH - 1>.net`, each adding a few isotopes, and
+    `wide.net` with `WIDE_NET_SIZE` isotopes.
+    """
+    nets_dir = join(root, 'data', 'net_data', 'nets')
+    os.makedirs(nets_dir)
+    isos = synthetic_isotopes(WIDE_NET_SIZE)
+    per_net = len(isos) // INCLUDE_DEPTH
+    for depth in range(INCLUDE_DEPTH):
+        with open(join(nets_dir, f'chain_{depth}.net'), 'w') as f:
+            if depth < INCLUDE_DEPTH - 1:
+                f.write(f"      include 'chain_{depth + 1}.net'\n")
+            f.write("      add_isos(\n")
+            for iso in isos[depth * per_net:(depth + 1) * per_net]:
+                f.write(f"         {iso}\n")
+            f.write("         )\n")
+    with open(join(nets_dir, 'wide.net'), 'w') as f:
+        f.write("      add_isos(\n")
+        # ranges of isotopes, like real nets
+        symbols = {}
+        for iso in isos[1:]:
+            symbol = iso.rstrip('0123456789')
+            symbols.setdefault(symbol, []).append(int(iso[len(symbol):]))
+        for symbol, mass_numbers in symbols.items():
+            f.write(f"         {symbol} {min(mass_numbers)} {max(mass_numbers)}\n")
+        f.write("         )\n")
+        f.write("      add_iso(neut)\n")
+
+def synthetic_composition(zones, isotopes, seed=0):
+    """Return a structured array of random, normalized compositions."""
+    rng = np.random.default_rng(seed)
+    dt = np.dtype([('xq', float)] + [(iso, float) for iso in isotopes])
+    data = rng.random((zones, len(isotopes) + 1))
+    data[:, 0] = np.linspace(0, 1, zones)
+    data[:, 1:] /= data[:, 1:].sum(axis=1, keepdims=True)
+    from numpy.lib.recfunctions import unstructured_to_structured
+    return unstructured_to_structured(data, dt)
+
+def synthetic_configs(isotopes, layers, seed=0):
+    """Return a surface composition and `layers` blend_comps configs."""
+    rng = np.random.default_rng(seed)
+    dt = np.dtype([(iso, float) for iso in isotopes])
+    comps = []
+    for _ in range(layers + 1):
+        comp = np.zeros(1, dtype=dt)
+        values = rng.random(len(isotopes))
+        comp[0] = tuple(values / values.sum())
+        comps.append(comp)
+    xq0s = np.geomspace(1e-8, 0.5, layers)
+    return comps[0], [(xq0, 0, comp) for xq0, comp in zip(xq0s, comps[1:])]
+
+def benchmarks(workdir, zones):
+    """Return (name, setup, function) for every benchmark.
+
+    `setup` is called before each run and `function` is timed.
+    """
+    import list_isos
+    from composition_blend import alternate_iso, blend_comps, make_composition_file
+
+    def clear_net_caches():
+        list_isos._resolved.clear()
+        list_isos._disk_cache = None
+        if os.path.exists(list_isos.NET_CACHE_FILE):
+            os.remove(list_isos.NET_CACHE_FILE)
+
+    def nothing():
+        pass
+
+    cases = []
+    for net in ['chain_0', 'wide']:
+        cases.append((f'isos_from_net[{net},cold]', clear_net_caches, lambda net=net: list_isos.isos_from_net(net)))
+        cases.append((f'isos_from_net[{net},warm]', nothing, lambda net=net: list_isos.isos_from_net(net)))
+
+    small_net = list_isos.isos_from_net('chain_20')
+    wide_net = list_isos.isos_from_net('wide')
+    for layers, points, shape in [(5, 2, 'linear'), (50, 2, 'linear'), (5, 2000, 'tanh'), (50, 2000, 'erf')]:
+        surf, configs = synthetic_configs(small_net, layers)
+        cases.append((f'blend_comps[layers={layers},points={points},{shape}]', nothing,
+                      lambda surf=surf, configs=configs, points=points, shape=shape:
+                      blend_comps(surf, configs, 0.3, points=points, shape=shape)))
+
+    # isotopes that are not in the small net get rerouted
+    source = small_net[:20] + ['ca48', 'ti50', 'fe60', 'ni64']
+    for n in zones:
+        comp = synthetic_composition(n, source)
+        cases.append((f'alternate_iso[zones={n}]', nothing,
+                      lambda comp=comp: alternate_iso('fe60', small_net, comp)))
+        if n in WRITE_ZONES:
+            filename = join(workdir, 'composition.data')
+            cases.append((f'make_composition_file[zones={n},isos={len(small_net)}]', nothing,
+                          lambda comp=comp, filename=filename:
+                          make_composition_file(comp, 'chain_20', filename, isotopes=small_net)))
+    for n in [n for n in WIDE_WRITE_ZONES if n <= max(zones)]:
+        comp = synthetic_composition(n, wide_net[::5])
+        filename = join(workdir, 'composition.data')
+        cases.append((f'make_composition_file[zones={n},isos={len(wide_net)}]', nothing,
+                      lambda comp=comp, filename=filename:
+                      make_composition_file(comp, 'wide', filename, isotopes=wide_net)))
+    return cases
+
+def run_benchmarks(repeat=5, quick=False, only=None):
+    """Run the benchmarks in a temporary fake `$MESA_DIR`.
+
+    Parameters
+    ----------
+    repeat : int, optional
+        The number of timed runs of each benchmark. The default is 5.
+    quick : bool, optional
+        If `True`, skip the largest arrays. The default is `False`.
+    only : list of str, optional
+        Only run these benchmarks, given by their full names or by the name
+        of the function they time (the part before the brackets).
+
+    Returns
+    -------
+    dict
+        Maps benchmark names to their median and minimum time in seconds and
+        peak traced memory in bytes.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        # list_isos reads these when it is first imported
+        os.environ['MESA_DIR'] = root
+        os.environ['WD_BUILDER_CACHE_DIR'] = join(root, 'cache')
+        sys.modules.pop('list_isos', None)
+        sys.modules.pop('composition_blend', None)
+        make_fake_mesa(root)
+        with open(os.devnull, 'w') as devnull:
+            for name, setup, function in benchmarks(root, QUICK_ZONES if quick else ZONES):
+                if only and name not in only and name.split('[')[0] not in only:
+                    continue
+                times = []
+                # what the code prints (like make_composition_file's notes on
+                # rerouted isotopes) would otherwise time the terminal
+                with redirect_stdout(devnull):
+                    for _ in range(repeat):
+                        setup()
+                        start = time.perf_counter()
+                        function()
+                        times.append(time.perf_counter() - start)
+                    setup()
+                    tracemalloc.start()
+                    function()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                results[name] = {'median': float(np.median(times)), 'min': min(times), 'peak_bytes': peak}
+                print(f"{name:60s} {results[name]['median'] * 1e3:10.3f} ms {peak / 2**20:10.2f} MiB", flush=True)
+    return results
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks that are slower than a baseline.
+
+    Parameters
+    ----------
+    results : dict
+        New results, as returned by `run_benchmarks`.
+    baseline : dict
+        Old results.
+    threshold : float
+        The allowed slowdown, as a fraction of the baseline time. The
+        fastest runs are compared, since they are the least noisy.
+
+    Returns
+    -------
+    list of (str, float)
+        The name and relative slowdown of each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result['min'] / baseline[name]['min'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append((name, change))
+            flag = '  REGRESSION'
+        print(f"{name:60s} {baseline[name]['min'] * 1e3:10.3f} -> {result['min'] * 1e3:10.3f} ms ({change:+.0%}){flag}")
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the composition pipeline on synthetic inputs.")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="compare with the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed slowdown before a benchmark counts as a regression (default: 0.25)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per benchmark (default: 5)")
+    parser.add_argument('--quick', action='store_true', help="skip the largest arrays")
+    parser.add_argument('--only', action='append', metavar='NAME',
+                        help="only run this benchmark, or the benchmarks of this function; can be repeated")
+    args = parser.parse_args(argv[1:])
+
+    results = run_benchmarks(args.repeat, args.quick, args.only)
+    if args.save:
+        record = {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'results': results,
+        }
+        with open(args.save, 'w') as f:
+            json.dump(record, f, indent=2)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print(f"\nCompared with {args.compare}:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,262 @@
+#! /usr/bin/env python3
+"""Reuse composition files whose inputs have not changed.
+
+Every build is identified by a hash of everything its output depends on: the
+contents of the reference model or .csv file, the sample and boundary
+locations, the resolved isotopes of the net, the transition settings, and the
+source code of the builders. Finished files are kept in `BUILD_CACHE_DIR`
+under that hash. A build whose hash is already there is hard-linked (or, across
+file systems, copied) to its destination instead of being computed again.
+
+The cache is kept below `MAX_CACHE_BYTES` and `MAX_CACHE_AGE_DAYS` by
+`evict`, which drops the least recently used files first. To trim or empty
+the cache by hand, run:
+
+    python build_cache.py [--max-bytes N] [--max-age-days D] [--clear]
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from functools import lru_cache
+from os import chmod, environ, getpid, link, makedirs, remove, replace, scandir, stat, utime
+from os.path import abspath, dirname, join, samestat
+
+from instrument import stage
+from list_isos import CACHE_DIR
+
+BUILD_CACHE_DIR = join(CACHE_DIR, 'builds')
+MAX_CACHE_BYTES = int(float(environ.get('WD_BUILDER_CACHE_MAX_BYTES', 2**30)))
+MAX_CACHE_AGE_DAYS = float(environ.get('WD_BUILDER_CACHE_MAX_AGE_DAYS', 30))
+# the modules whose code decides what a build writes
+CODE_FILES = ('build_cache.py', 'composition_blend.py', 'composition_file.py', 'ensemble.py', 'list_isos.py',
+              'manual_composition.py', 'modular_composition.py', 'profile_reader.py', 'resample.py')
+
+@lru_cache(maxsize=None)
+def code_version():
+    "Return a hash of the source of every module in `CODE_FILES`."
+    digest = hashlib.sha256()
+    directory = dirname(abspath(__file__))
+    for name in CODE_FILES:
+        with open(join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+@lru_cache(maxsize=None)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+@stage('hash inputs')
+def file_digest(filename):
+    """Return a hash of a file's contents.
+
+    Memoized on the file's path, modification time, and size, so each input
+    is read at most once per process.
+    """
+    info = stat(filename)
+    return _file_digest(abspath(filename), info.st_mtime_ns, info.st_size)
+
+def build_key(**inputs):
+    """Return the cache key of a build.
+
+    Parameters
+    ----------
+    **inputs
+        Everything the build's output depends on besides the code, as
+        JSON-serializable values (hash input files with `file_digest`).
+
+    Returns
+    -------
+    str
+        A hex digest of `inputs` and `code_version()`.
+    """
+    record = json.dumps({'code': code_version(), **inputs}, sort_keys=True)
+    return hashlib.sha256(record.encode()).hexdigest()
+
+def modular_key(model_file, isotopes, sample_xqs=None, boundary_xqs=None, resample=None,
+                multiplier=1e-6, points=2, shape='linear'):
+    """Return the cache key of a build from a reference model.
+
+    Parameters
+    ----------
+    model_file : str
+        The reference MESA profile.
+    isotopes : list of str
+        The isotopes of the model's net.
+    sample_xqs, boundary_xqs : list of float, optional
+        The sample and boundary locations, for a layered build.
+    resample : float, optional
+        The tolerance of a resampled build (see `resampled_composition`).
+    multiplier, points, shape : optional
+        The transition settings (see `blend_comps`).
+    """
+    return build_key(method='modular', model=file_digest(model_file), isotopes=list(isotopes),
+                     sample_xqs=None if sample_xqs is None else [float(xq) for xq in sample_xqs],
+                     boundary_xqs=None if boundary_xqs is None else [float(xq) for xq in boundary_xqs],
+                     resample=resample, multiplier=multiplier, points=points, shape=shape)
+
+def ensemble_key(model_files, isotopes, sample_xqs, boundary_xqs, grid, statistic,
+                 multiplier=1e-6, points=2, shape='linear'):
+    """Return the cache key of a build from an ensemble of reference models.
+
+    Parameters
+    ----------
+    model_files : list of str
+        The MESA profiles of the models.
+    isotopes : list of str
+        The isotopes of the net.
+    sample_xqs, boundary_xqs : list of float
+        The sample and boundary locations.
+    grid : np.ndarray
+        The xq grid the models are combined on.
+    statistic : str
+        How the models are combined (see `ensemble_reference`).
+    multiplier, points, shape : optional
+        The transition settings (see `blend_comps`).
+    """
+    return build_key(method='ensemble', models=[file_digest(model_file) for model_file in model_files],
+                     isotopes=list(isotopes), sample_xqs=[float(xq) for xq in sample_xqs],
+                     boundary_xqs=[float(xq) for xq in boundary_xqs], grid=[float(xq) for xq in grid],
+                     statistic=statistic, multiplier=multiplier, points=points, shape=shape)
+
+def manual_key(csv_file, isotopes, multiplier=1e-6, points=2, shape='linear'):
+    """Return the cache key of a build from a .csv file of layers.
+
+    Parameters
+    ----------
+    csv_file : str
+        The .csv file.
+    isotopes : list of str
+        The isotopes of the net.
+    multiplier, points, shape : optional
+        The transition settings (see `blend_comps`).
+    """
+    return build_key(method='manual', csv=file_digest(csv_file), isotopes=list(isotopes),
+                     multiplier=multiplier, points=points, shape=shape)
+
+# the formats a build can write (see composition_file.write_composition)
+EXTENSIONS = ('.data', '.npz', '.npy')
+
+def cache_entry(key, extension='.data'):
+    "Return the name of the cached file for a key, in the format of `extension`."
+    return join(BUILD_CACHE_DIR, f'{key}{extension}')
+
+@stage('place output')
+def _place(entry, filename):
+    """Put a cached file at `filename`, replacing whatever is there."""
+    try:
+        if samestat(stat(entry), stat(filename)):
+            # already linked; renaming onto the same file would do nothing
+            return
+    except FileNotFoundError:
+        pass
+    tmp_name = f"{filename}.{getpid()}.tmp"
+    try:
+        link(entry, tmp_name)
+    except OSError:
+        from shutil import copyfile
+        copyfile(entry, tmp_name)
+    replace(tmp_name, filename)
+
+def cached_build(key, filename, build):
+    """Write a build's output to `filename`, from the cache if possible.
+
+    Parameters
+    ----------
+    key : str
+        The build's key, from `build_key`.
+    filename : str
+        Where to put the output. An .npz or .npy extension is cached
+        separately from the text file of the same build.
+    build : callable
+        Called as `build(name)` to write the output to the file `name` when
+        it is not cached. `name` ends with the extension of `filename` if
+        that is .npz or .npy.
+
+    Returns
+    -------
+    bool
+        `True` if the output came from the cache.
+    """
+    extension = next((ext for ext in EXTENSIONS[1:] if filename.endswith(ext)), '.data')
+    entry = cache_entry(key, extension)
+    try:
+        _place(entry, filename)
+        # mark the entry as recently used
+        utime(entry)
+        return True
+    except OSError:
+        pass
+    tmp_name = f"{entry}.{getpid()}.tmp" + (extension if extension != '.data' else '')
+    try:
+        makedirs(BUILD_CACHE_DIR, exist_ok=True)
+        build(tmp_name)
+        # the destination may be a hard link to the entry, so keep anyone
+        # from editing the entry through it
+        chmod(tmp_name, 0o444)
+        replace(tmp_name, entry)
+        _place(entry, filename)
+    except OSError:
+        # the cache is only an optimization
+        try:
+            remove(tmp_name)
+        except OSError:
+            pass
+        build(filename)
+    return False
+
+@stage('evict cache')
+def evict(max_bytes=MAX_CACHE_BYTES, max_age_days=MAX_CACHE_AGE_DAYS):
+    """Remove old cached files until the cache is within its limits.
+
+    Files not used for more than `max_age_days` are removed, and then the
+    least recently used files until the rest take up at most `max_bytes`.
+    Files that have been linked elsewhere stay there.
+
+    Returns
+    -------
+    int
+        The number of files removed.
+    """
+    try:
+        entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                   for e in scandir(BUILD_CACHE_DIR) if e.name.endswith(EXTENSIONS) and '.tmp' not in e.name]
+    except OSError:
+        return 0
+    # most recently used first
+    entries.sort(reverse=True)
+    oldest = time.time() - max_age_days * 86400
+    total = 0
+    removed = 0
+    for mtime, size, path in entries:
+        total += size
+        if mtime < oldest or total > max_bytes:
+            try:
+                remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Trim the cache of built composition files.")
+    parser.add_argument('--max-bytes', type=float, default=MAX_CACHE_BYTES,
+                        help=f"largest total size to keep (default: {MAX_CACHE_BYTES})")
+    parser.add_argument('--max-age-days', type=float, default=MAX_CACHE_AGE_DAYS,
+                        help=f"remove files not used for this long (default: {MAX_CACHE_AGE_DAYS:g})")
+    parser.add_argument('--clear', action='store_true', help="remove every cached file")
+    args = parser.parse_args(argv[1:])
+
+    if args.clear:
+        removed = evict(0, 0)
+    else:
+        removed = evict(args.max_bytes, args.max_age_days)
+    print(f"Removed {removed} files from {BUILD_CACHE_DIR}.")
+
+if __name__ == "__main__":
+    main(sys.argv)
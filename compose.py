@@ -0,0 +1,199 @@
+"""Build compositions in memory, for use as a library.
+
+The functions here do what the builders in wd_profile_builder.py do, but
+return the composition instead of writing it, updating an inlist, or using
+the build cache:
+
+    import compose
+    comp = compose.modular('LOGS/profile1.data', [1e-6, 1e-3, 0.5], [1e-4, 1e-2], net='co_burn')
+    comp.xq, comp.matrix, comp.isotopes
+
+Each returns a `composition_file.Composition`: the xq of each row, a
+C-contiguous matrix of mass fractions with one column per isotope of the
+net, in net order, and the names of those isotopes. The matrix is what
+`make_composition_file` would write, so builds can be chained, compared, or
+analyzed without writing and parsing text files. Save one with
+`composition_file.write_composition`, as text for MESA or as an .npz or .npy
+file. Nothing is written to disk: profiles are parsed without their binary
+snapshots (see `read_profile`), and nets are resolved without saving them to
+the net cache (see `list_isos.memory_only`). Nothing is printed either: CSV
+isotopes that are not in the net, and mass moved from isotopes not in the
+net to others, are reported with `warnings.warn`, pointing at the caller.
+"""
+import warnings
+
+import numpy as np
+
+from composition_blend import net_matrix
+from composition_file import Composition
+from list_isos import isos_from_net, memory_only, resolve_net
+
+def _to_net(comp_array, isotopes):
+    "Return a composition array in net order and the warnings about mass moved between isotopes."
+    matrix, moved = net_matrix(comp_array, isotopes)
+    messages = [f"Isotope {iso} not in net. Moved its mass ({mass:.3e}) into {target}."
+                for iso, target, mass in moved]
+    return Composition(np.ascontiguousarray(comp_array['xq']), matrix, list(isotopes)), messages
+
+def to_net(comp_array, net=None, isotopes=None):
+    """Put a structured composition array in net order.
+
+    Parameters
+    ----------
+    comp_array : np.array
+        A structured array of compositions, like the one returned by
+        `blend_comps`. It is not modified.
+    net : str, optional
+        The net. Not needed if `isotopes` is given.
+    isotopes : list of str, optional
+        The isotopes of the net, if already looked up with `isos_from_net`.
+
+    Returns
+    -------
+    Composition
+    """
+    if isotopes is None:
+        with memory_only():
+            isotopes = isos_from_net(net)
+    composition, messages = _to_net(comp_array, isotopes)
+    for message in messages:
+        warnings.warn(message, stacklevel=2)
+    return composition
+
+def _check_layers(sample_xqs, boundary_xqs):
+    if sample_xqs is None or boundary_xqs is None:
+        raise ValueError("sample_xqs and boundary_xqs are required")
+    if len(boundary_xqs) != len(sample_xqs) - 1:
+        raise ValueError("boundary_xqs must be exactly 1 element shorter than sample_xqs")
+
+def modular(model, sample_xqs=None, boundary_xqs=None, net=None, resample=None,
+            multiplier=1e-6, points=2, shape='linear'):
+    """Sample the composition of a reference model.
+
+    Parameters
+    ----------
+    model : str, ProfileData, or tuple
+        The reference MESA profile: its file name, the profile returned by
+        `read_profile`, or the arrays returned by `reference_profile`.
+        Passing the loaded profile lets many builds share it.
+    sample_xqs, boundary_xqs : list of float, optional
+        The layers to sample; see `modular_blend`. Required unless
+        `resample` is given.
+    net : str, optional
+        The net to write the composition for. The default is the model's
+        net; 'auto' is the smallest net that holds every isotope with mass
+        in the model. Required if `model` is a tuple.
+    resample : float, optional
+        Keep the whole profile, to within this abundance tolerance, instead
+        of sampling layers (see `resampled_composition`).
+    multiplier, points, shape : optional
+        Control the transitions between layers; passed on to `blend_comps`.
+
+    Returns
+    -------
+    Composition
+    """
+    from modular_composition import auto_net, modular_blend, reference_profile, resampled_composition
+
+    model_net = None
+    if isinstance(model, tuple):
+        reference = model
+    else:
+        if isinstance(model, str):
+            from profile_reader import read_profile
+            model = read_profile(model, snapshot=False)
+        reference = reference_profile(model)
+        model_net = model.header('net_name')
+    if net is None:
+        if model_net is None:
+            raise ValueError("net is required for a reference profile without a header")
+        net = model_net
+    with memory_only():
+        if net == 'auto':
+            net = auto_net(reference, model_net)[0]
+        isotopes = isos_from_net(net)
+    if resample is not None:
+        blend = resampled_composition(reference, resample)
+    else:
+        _check_layers(sample_xqs, boundary_xqs)
+        blend = modular_blend(reference, sample_xqs, boundary_xqs, multiplier, points, shape)
+    composition, messages = _to_net(blend, isotopes)
+    for message in messages:
+        warnings.warn(message, stacklevel=2)
+    return composition
+
+def manual(csv, net, multiplier=1e-6, points=2, shape='linear'):
+    """Blend the layers listed in a CSV file.
+
+    Parameters
+    ----------
+    csv : str or tuple
+        The CSV file (see manual_composition.py), or its columns and table
+        as returned by `read_csv_table`.
+    net : str
+        The net, or 'auto' for the smallest net that holds every isotope of
+        the CSV file.
+    multiplier, points, shape : optional
+        Control the transitions between layers; passed on to `blend_comps`.
+
+    Returns
+    -------
+    Composition
+    """
+    from manual_composition import manual_blend, read_csv_table
+
+    columns, table = read_csv_table(csv) if isinstance(csv, str) else csv
+    if 'xq' not in columns:
+        raise ValueError("CSV must have an 'xq' column")
+    with memory_only():
+        net = resolve_net(net, [iso for iso in columns if iso != 'xq'])
+        isotopes = isos_from_net(net)
+    messages = []
+    blend = manual_blend(columns, table, isotopes, net, multiplier, points, shape, warn=messages.append)
+    composition, moved = _to_net(blend, isotopes)
+    for message in messages + moved:
+        warnings.warn(message, stacklevel=2)
+    return composition
+
+def ensemble(model_files, sample_xqs, boundary_xqs, net=None, statistic='median', grid=None,
+             multiplier=1e-6, points=2, shape='linear', threads=None):
+    """Sample the combined composition of many reference models.
+
+    Parameters
+    ----------
+    model_files : list of str
+        The MESA profiles of the models.
+    sample_xqs, boundary_xqs : list of float
+        The layers to sample; see `modular_blend`.
+    net : str, optional
+        The net to write the composition for. The default is the models'
+        net, which must then be the same for all of them; 'auto' is the
+        smallest net that holds every isotope with mass in the combined
+        profile.
+    statistic, grid, threads : optional
+        How to combine the models; see `ensemble_reference`.
+    multiplier, points, shape : optional
+        Control the transitions between layers; passed on to `blend_comps`.
+
+    Returns
+    -------
+    Composition
+    """
+    from ensemble import ensemble_reference
+    from modular_composition import auto_net, modular_blend
+
+    _check_layers(sample_xqs, boundary_xqs)
+    reference, _, nets = ensemble_reference(model_files, grid, statistic, threads=threads, snapshot=False)
+    if net is None:
+        if len(set(nets)) > 1:
+            raise ValueError(f"The models use different nets ({', '.join(sorted(set(nets)))}); choose one")
+        net = nets[0]
+    with memory_only():
+        if net == 'auto':
+            net = auto_net(reference, nets[0])[0]
+        isotopes = isos_from_net(net)
+    blend = modular_blend(reference, sample_xqs, boundary_xqs, multiplier, points, shape)
+    composition, messages = _to_net(blend, isotopes)
+    for message in messages:
+        warnings.warn(message, stacklevel=2)
+    return composition
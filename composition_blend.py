@@ -1,8 +1,74 @@
+import math
+from functools import lru_cache
+from os import getpid, remove, replace
 import numpy as np
-from numpy.lib.recfunctions import append_fields
-from list_isos import isos_from_net
+from numpy.lib.recfunctions import structured_to_unstructured, unstructured_to_structured
+from composition_file import Composition, write_composition
+from instrument import stage
+from list_isos import isos_from_net, isotope_id, isotope_ids, isotope_z
 
-def blend_comps(comp_surf, configs, multiplier=1e-6):
+TRANSITION_SHAPES = ('linear', 'tanh', 'erf')
+
+def transition_weights(t, shape='linear', steepness=3.0):
+    """Return the fraction of the inner composition across a transition.
+
+    Parameters
+    ----------
+    t : np.ndarray
+        Positions within the transition, from -1 (outer edge) to 1 (inner
+        edge), linear in the log of the fractional external mass coordinate.
+    shape : str, optional
+        One of `TRANSITION_SHAPES`. The default is 'linear'.
+    steepness : float, optional
+        How sharply the 'tanh' and 'erf' shapes change at the center of the
+        transition. The default is 3.
+
+    Returns
+    -------
+    np.ndarray
+        The weights, rising monotonically from 0 at t = -1 to 1 at t = 1.
+    """
+    t = np.asarray(t, dtype=float)
+    if shape == 'linear':
+        return (t + 1) / 2
+    if shape == 'tanh':
+        return (1 + np.tanh(steepness * t) / np.tanh(steepness)) / 2
+    if shape == 'erf':
+        erf = np.frompyfunc(math.erf, 1, 1)
+        return (1 + erf(steepness * t).astype(float) / math.erf(steepness)) / 2
+    raise ValueError(f"Unknown transition shape {shape!r}; use one of {TRANSITION_SHAPES}")
+
+def transition_nodes(points, shape='linear', steepness=3.0):
+    """Return where to put the points of a transition.
+
+    Points are spaced evenly along the length of the weight curve, so they
+    are densest where the composition changes fastest while still covering
+    the flat edges of the transition.
+
+    Parameters
+    ----------
+    points : int
+        The number of points per transition, at least 2.
+    shape, steepness
+        See `transition_weights`.
+
+    Returns
+    -------
+    np.ndarray
+        Positions from -1 to 1 (see `transition_weights`), starting and
+        ending exactly at the edges.
+    """
+    if points < 2:
+        raise ValueError("A transition needs at least 2 points")
+    if points == 2:
+        return np.array([-1.0, 1.0])
+    fine = np.linspace(-1, 1, min(16 * points, 1 << 14) + 1)
+    weights = transition_weights(fine, shape, steepness)
+    # both axes span 1 so neither dominates the arc length
+    arc = np.concatenate([[0], np.cumsum(np.hypot(np.diff(fine) / 2, np.diff(weights)))])
+    return np.interp(np.linspace(0, arc[-1], points), arc, fine)
+
+def blend_comps(comp_surf, configs, multiplier=1e-6, points=2, shape='linear', steepness=3.0):
     """Create a structured array of blended compositions.
     
     Parameters
@@ -14,12 +80,24 @@ def blend_comps(comp_surf, configs, multiplier=1e-6):
         the width of the transition in mass coordinate space, and a one-element
         structured array of the composition to blend to through this transition.
         The list should be ordered by increasing transition external mass
-        coordinate (ending with the core composition).
+        coordinate (ending with the core composition). A width of 0 means the
+        width is set by `multiplier`.
     multiplier : float, optional
         Relative steepness of transitions. At each transition, the difference
         in external fractional mass coordinate between the two composisitions is
         computed as this value multiplied by the external fractional mass at the
         transition. The default is 1e-6.
+    points : int, optional
+        The number of points in each transition. The default of 2 puts the
+        outer composition at the outer edge and the inner composition at the
+        inner edge. More points give a smooth profile that is easier for
+        MESA to relax to, placed by `transition_nodes`.
+    shape : str, optional
+        The shape of the transitions, one of `TRANSITION_SHAPES`. Only
+        matters if `points` is more than 2. The default is 'linear' in the
+        log of the fractional external mass coordinate.
+    steepness : float, optional
+        See `transition_weights`. The default is 3.
     
     Returns
     -------
@@ -30,58 +108,122 @@ def blend_comps(comp_surf, configs, multiplier=1e-6):
         composition and 1 for the core composition, which should be the last
         composition in the list.
     """
-    ###############################
-    # Set up the structured array #
-    ###############################
     dt = np.dtype([('xq', float)] + [(name, float) for name in comp_surf.dtype.names])
-    # each composition gets a starting and a stopping point, so two points
-    # per composition, which is the length of the configs list plus one more
-    # for the surface composition.
-    length = 2 * len(configs) + 2
-    data = np.zeros(length, dtype=dt)
-
-    def xq_comp_tuple(xq, comp):
-        """Return a tuple of the external mass and the composition values.
-        
-        Main purpose is to create rows of the main structured array, which
-        have a external fractional mass coordinate followed by the isotopic
-        mass fractions.
-        
-        Parameters
-        ----------
-        xq : float
-            The fractional external mass coordinate.
-        comp : np.array
-            The composition.
-        
-        Returns
-        -------
-        tuple
-        """
-        return tuple([xq] + [comp[name] for name in comp.dtype.names])
-    
-    # set core and surface compositions
-    data[0] = xq_comp_tuple(0, comp_surf)
-    data[-1] = xq_comp_tuple(1, configs[-1][-1])
-
-    # iterate through the transition points and blend between compositions
-    prev_comp = comp_surf
-    for i, (xq0, dxq, comp) in enumerate(configs):
-        # each transition gets two points. The first is the outer
-        # composition and the second is the inner composition. Somewhat
-        # arbitrarily choose the width of the transition to be 1e-6 the
-        # fractional external mass coordinate at the transition to make
-        # sharp, but not discontinuous transitions.
-
-        dxq = multiplier * xq0
-        # old composition
-        prev_comp = comp_surf if i == 0 else configs[i-1][-1]
-        data[2 * i + 1] = xq_comp_tuple(xq0-dxq, prev_comp)
-        # new composition
-        if i <= len(configs) - 1:
-            data[2 * i + 2] = xq_comp_tuple(xq0+dxq, comp)
-
-    return data
+    # one row per composition, from the surface inward
+    comps = np.vstack([structured_to_unstructured(np.atleast_1d(comp), dtype=float).reshape(-1)
+                       for comp in [comp_surf] + [config[-1] for config in configs]])
+    xq0 = np.array([config[0] for config in configs], dtype=float)
+    dxq = np.array([config[1] for config in configs], dtype=float)
+    xq, matrix = blend_matrix(comps, xq0, dxq, multiplier, points, shape, steepness)
+    data = np.empty((len(xq), len(dt.names)))
+    data[:, 0] = xq
+    data[:, 1:] = matrix
+    return unstructured_to_structured(data, dt)
+
+def _transitions(comps, xq0, dxq, multiplier, t, weights):
+    """Return the xq and mass fractions of the points of each transition.
+
+    Transition k goes from `comps[k]` to `comps[k + 1]` around `xq0[k]`.
+    Every transition shares the same relative point placement `t` and
+    `weights`, so all of them are evaluated at once as (transition, point)
+    arrays, and each point only depends on its own transition.
+    """
+    # Somewhat arbitrarily choose the half-width of the transition to be 1e-6
+    # the fractional external mass coordinate at the transition to make
+    # sharp, but not discontinuous transitions.
+    dxq = np.where(dxq > 0, dxq, multiplier * xq0)
+    outer = xq0 - dxq
+    inner = xq0 + dxq
+    frac = (t + 1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xqs = np.where(outer[:, None] > 0,
+                       outer[:, None] * (inner / outer)[:, None] ** frac,
+                       outer[:, None] + (inner - outer)[:, None] * frac)
+    xqs[:, 0] = outer
+    xqs[:, -1] = inner
+    blended = (comps[:-1, None, :] * (1 - weights)[None, :, None]
+               + comps[1:, None, :] * weights[None, :, None])
+    # the edges are exactly the neighbouring compositions
+    blended[:, 0] = comps[:-1]
+    blended[:, -1] = comps[1:]
+    return xqs.ravel(), blended.reshape(-1, comps.shape[1])
+
+@stage('blend')
+def blend_matrix(comps, xq0, dxq=None, multiplier=1e-6, points=2, shape='linear', steepness=3.0):
+    """Blend a matrix of compositions, like `blend_comps`.
+
+    Parameters
+    ----------
+    comps : np.ndarray
+        The mass fractions of each composition, with one row per composition
+        from the surface to the core.
+    xq0 : np.ndarray
+        The fractional external mass coordinate of each transition; one fewer
+        than there are compositions.
+    dxq : np.ndarray, optional
+        The width of each transition. Widths of 0, and the default, mean the
+        width is set by `multiplier`.
+    multiplier, points, shape, steepness : optional
+        See `blend_comps`.
+
+    Returns
+    -------
+    xq : np.ndarray
+        The fractional external mass coordinate of each row, from 0 to 1.
+    matrix : np.ndarray
+        The mass fractions, with one row per xq and the columns of `comps`.
+    """
+    comps = np.asarray(comps, dtype=float)
+    xq0 = np.asarray(xq0, dtype=float)
+    dxq = np.zeros_like(xq0) if dxq is None else np.asarray(dxq, dtype=float)
+    t = transition_nodes(points, shape, steepness)
+    xqs, blended = _transitions(comps, xq0, dxq, multiplier, t, transition_weights(t, shape, steepness))
+    # surface and core compositions at xq = 0 and 1, with every transition
+    # in between
+    xq = np.concatenate([[0], xqs, [1]])
+    matrix = np.concatenate([comps[:1], blended, comps[-1:]])
+    return xq, matrix
+
+def blend_stream(layers, multiplier=1e-6, points=2, shape='linear', steepness=3.0):
+    """Blend compositions that arrive in chunks, like `blend_matrix`.
+
+    Parameters
+    ----------
+    layers : iterable of (np.ndarray, np.ndarray)
+        Chunks of layers as (xq, comps) pairs, from the surface inward. Each
+        layer's xq is the outer edge of the transition to the next layer, so
+        the last layer's xq is not used. Transitions have the widths set by
+        `multiplier`.
+    multiplier, points, shape, steepness : optional
+        See `blend_comps`.
+
+    Yields
+    ------
+    (np.ndarray, np.ndarray)
+        Chunks of the rows `blend_matrix` would return, in order: the
+        surface row, the transitions of each chunk of layers, and the core
+        row. Only one chunk of layers is held in memory at a time.
+    """
+    t = transition_nodes(points, shape, steepness)
+    weights = transition_weights(t, shape, steepness)
+    last = None
+    for xq, comps in layers:
+        if not len(xq):
+            continue
+        if last is None:
+            yield np.zeros(1), comps[:1]
+        else:
+            # the transition from the last layer of the previous chunk
+            xq = np.concatenate([[last[0]], xq])
+            comps = np.concatenate([last[1][None], comps])
+        last = xq[-1], comps[-1]
+        if len(xq) > 1:
+            with stage('blend'):
+                chunk = _transitions(comps, xq[:-1], np.zeros(len(xq) - 1), multiplier, t, weights)
+            yield chunk
+    if last is None:
+        raise ValueError("There are no layers to blend")
+    yield np.ones(1), last[1][None]
 
 def alternate_iso(iso, isotopes, comp_array, use_max=True):
     """Find an alternate isotope in a composition array.
@@ -115,11 +257,12 @@ def alternate_iso(iso, isotopes, comp_array, use_max=True):
     ValueError
         If `use_max` is `False` and no suitable replacement is found.
     """
-    element = "".join([c for c in iso if c.isalpha()])
-    alternates = []
-    for name in comp_array.dtype.names:
-        if element == "".join([c for c in name if c.isalpha()]) and name in isotopes:
-            alternates.append(name)
+    names = comp_array.dtype.names[1:]
+    # compare elements by atomic number, from the isotope table
+    z = isotope_z(isotope_ids(names))
+    element = isotope_z(isotope_id(iso))
+    acceptable = set(isotopes)
+    alternates = [name for name, name_z in zip(names, z) if name_z == element and name in acceptable]
     if alternates:
         # find the isotope with the largest total mass in the model
         dqs = np.diff(comp_array['xq'])
@@ -130,13 +273,10 @@ def alternate_iso(iso, isotopes, comp_array, use_max=True):
         # if no suitable replacement is found, use the element with the largest 
         # atomic number and the isotope of that element with the largest total
         # mass in the model
-        max_element = isotopes[-1].strip("1234567890")
+        max_element = isotope_z(isotope_id(isotopes[-1]))
         # find all isotopes of the element with the largest atomic number in
         # the model (there may be none)
-        alternates = []
-        for name in comp_array.dtype.names:
-            if max_element == "".join([c for c in name if c.isalpha()]):
-                alternates.append(name)
+        alternates = [name for name, name_z in zip(names, z) if name_z == max_element]
         if len(alternates) == 0:
             return isotopes[-1]
         elif len(alternates) == 1:
@@ -149,7 +289,225 @@ def alternate_iso(iso, isotopes, comp_array, use_max=True):
     else:
         raise ValueError(f"Isotope {iso} not in composition array and there are no suitable replacements.")
 
-def make_composition_file(comp_array, net, filename):
+@lru_cache(maxsize=128)
+def _remap_plan(source_isos, isotopes):
+    """Work out where each source isotope's mass can go in a net.
+
+    Depends only on the isotope names, so it is cached per (source isotopes,
+    net isotopes) pair.
+
+    Returns
+    -------
+    targets : np.ndarray of int
+        The index in `isotopes` of each source isotope, or -1 if it is not in
+        the net.
+    reroutes : list of tuple
+        For each source isotope not in the net: its index in `source_isos`,
+        the indices in `source_isos` and in `isotopes` of the candidate
+        replacements, and the index in `isotopes` to use if there are no
+        candidates.
+    """
+    net_index = {iso: j for j, iso in enumerate(isotopes)}
+    targets = np.array([net_index.get(iso, -1) for iso in source_isos], dtype=int)
+    # elements are compared by atomic number, so prot counts as hydrogen
+    elements = isotope_z(isotope_ids(source_isos))
+    max_element = isotope_z(isotope_id(isotopes[-1]))
+    in_net = targets >= 0
+    reroutes = []
+    for i in np.flatnonzero(~in_net):
+        # isotopes of the same element that are in both the composition and
+        # the net; failing that, isotopes of the net's heaviest element
+        candidates = np.flatnonzero(in_net & (elements == elements[i]))
+        if not len(candidates):
+            candidates = np.flatnonzero(in_net & (elements == max_element))
+        reroutes.append((i, candidates, targets[candidates], len(isotopes) - 1))
+    return targets, reroutes
+
+def isotope_remap(source_isos, isotopes, masses):
+    """Return the net isotope that receives each source isotope's mass.
+
+    Isotopes in the net keep their own mass. The mass of any other isotope
+    goes to the isotope of the same element with the largest total mass in
+    the composition, or, if there is none, to the isotope of the net's
+    heaviest element with the largest total mass (see `alternate_iso`).
+    Falls back to the last isotope of the net.
+
+    Parameters
+    ----------
+    source_isos : sequence of str
+        The isotopes of the composition.
+    isotopes : sequence of str
+        The isotopes of the net.
+    masses : np.ndarray
+        The total mass of each source isotope in the composition.
+
+    Returns
+    -------
+    np.ndarray of int
+        The index in `isotopes` of the target of each source isotope.
+    """
+    targets, reroutes = _remap_plan(tuple(source_isos), tuple(isotopes))
+    targets = targets.copy()
+    for i, candidates, candidate_targets, fallback in reroutes:
+        targets[i] = candidate_targets[np.argmax(masses[candidates])] if len(candidates) else fallback
+    return targets
+
+def apply_remap(block, targets, num_isos):
+    """Move the mass of each source isotope column into its target column.
+
+    Each source column is added to exactly one target column, so the mass
+    of every row is conserved. Source columns are grouped by target and
+    summed in one pass over `block`, however many isotopes are rerouted.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Mass fractions, with one column per source isotope.
+    targets : np.ndarray of int
+        The target of each source isotope, as returned by `isotope_remap`.
+    num_isos : int
+        The number of isotopes in the net.
+
+    Returns
+    -------
+    np.ndarray
+        A C-contiguous array of shape (len(block), num_isos). Columns that
+        receive no mass are zero.
+    """
+    matrix = np.zeros((len(block), num_isos))
+    if not len(targets):
+        return matrix
+    # group the source columns by target and sum each group
+    order = np.argsort(targets, kind='stable')
+    sorted_targets = targets[order]
+    starts = np.flatnonzero(np.r_[True, sorted_targets[1:] != sorted_targets[:-1]])
+    matrix[:, sorted_targets[starts]] = np.add.reduceat(block[:, order], starts, axis=1)
+    return matrix
+
+def write_composition_chunks(rows, num_isos, chunks, filename, chunk_rows=4096):
+    """Write chunks of xq coordinates and mass fractions to a file.
+
+    The output is the text format read by `wd_builder`: a header line with
+    the number of rows and isotopes, followed by one line per row with xq and
+    the mass fraction of every isotope. Rows are formatted and written in
+    chunks, so memory use does not grow with the number of rows.
+
+    Parameters
+    ----------
+    rows : int
+        The total number of rows in `chunks`, for the header.
+    num_isos : int
+        The number of isotopes.
+    chunks : iterable of (np.ndarray, np.ndarray)
+        (xq, matrix) pairs, where matrix has shape (len(xq), num_isos), as
+        yielded by `blend_stream`.
+    filename : str
+        The name of the file to write the composition to. If the file already
+        exists, it will be overwritten.
+    chunk_rows : int, optional
+        The number of rows formatted per write. The default is 4096.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ValueError
+        If `chunks` does not hold `rows` rows.
+    """
+    # one format string per row; the whole chunk is formatted in one go
+    row_format = "%.15e" + " %.8e" * num_isos
+    block = np.empty((chunk_rows, num_isos + 1), dtype=float)
+    written = 0
+    # write to a temporary file and rename it, so an existing file (which
+    # may be a hard link into the build cache) is replaced, not rewritten
+    tmp_name = f"{filename}.{getpid()}.tmp"
+    try:
+        with open(tmp_name, 'w', buffering=1 << 20) as f:
+            f.write(f"{rows} {num_isos}")
+            for xq, matrix in chunks:
+                # timed per chunk, so the work of producing `chunks` is not
+                # counted as writing
+                with stage('write'):
+                    for start in range(0, len(xq), chunk_rows):
+                        stop = min(start + chunk_rows, len(xq))
+                        chunk = block[:stop - start]
+                        chunk[:, 0] = xq[start:stop]
+                        chunk[:, 1:] = matrix[start:stop]
+                        f.write("\n")
+                        f.write("\n".join([row_format] * len(chunk)) % tuple(chunk.ravel().tolist()))
+                written += len(xq)
+        if written != rows:
+            raise ValueError(f"Wrote {written} rows to {filename}, but its header says {rows}")
+    except BaseException:
+        try:
+            remove(tmp_name)
+        except OSError:
+            pass
+        raise
+    replace(tmp_name, filename)
+
+def write_composition_matrix(xq, matrix, filename, chunk_rows=4096):
+    """Write xq coordinates and a matrix of mass fractions to a file.
+
+    See `write_composition_chunks` for the format.
+
+    Parameters
+    ----------
+    xq : np.array
+        The fractional external mass coordinates, one per row.
+    matrix : np.ndarray
+        The mass fractions, with shape (len(xq), number of isotopes).
+    filename : str
+        The name of the file to write the composition to. If the file already
+        exists, it will be overwritten.
+    chunk_rows : int, optional
+        The number of rows formatted per write. The default is 4096.
+
+    Returns
+    -------
+    None
+    """
+    rows, num_isos = matrix.shape
+    write_composition_chunks(rows, num_isos, [(xq, matrix)], filename, chunk_rows)
+
+@stage('remap')
+def net_matrix(comp_array, isotopes):
+    """Put the mass fractions of a composition array in net order.
+
+    Isotopes of the net that are not in the composition array are zero, and
+    the mass of isotopes that are not in the net is moved to other isotopes
+    (see `isotope_remap`). `comp_array` is not modified.
+
+    Parameters
+    ----------
+    comp_array : np.array
+        The structured array of compositions, like the one returned by
+        `blend_comps`.
+    isotopes : list of str
+        The isotopes of the net, as returned by `isos_from_net`.
+
+    Returns
+    -------
+    matrix : np.ndarray
+        A C-contiguous array of shape (len(comp_array), len(isotopes)).
+    moved : list of (str, str, float)
+        The isotopes that are not in the net, the isotope each one's mass
+        went to, and that total mass.
+    """
+    source_isos = comp_array.dtype.names[1:]
+    block = structured_to_unstructured(comp_array[list(source_isos)], dtype=float)
+    # total mass of each isotope, used to choose where to dump isotopes that
+    # are not in the net
+    masses = np.diff(comp_array['xq']) @ block[:-1]
+    targets = isotope_remap(source_isos, isotopes, masses)
+    net_isos = set(isotopes)
+    moved = [(source_isos[i], isotopes[targets[i]], float(masses[i]))
+             for i in np.flatnonzero([iso not in net_isos for iso in source_isos])]
+    return apply_remap(block, targets, len(isotopes)), moved
+
+def make_composition_file(comp_array, net, filename, isotopes=None):
     """Write a composition array to a file.
 
     Must have a structured array of xq coordinates and isotopic mass fractions,
@@ -163,36 +521,22 @@ def make_composition_file(comp_array, net, filename):
         isotopic mass fractions. This is the kind of array that is returned by
         `blend_comps`.
     net : str
-        The name of the net file to use. This is used to get the list of isotopes in the composition array. Note that all isotopes in the net file must be present in the composition array.
+        The name of the net file to use. This is used to get the list of isotopes in the composition array. Isotopes of the net that are not in the composition array are written as zeros, and the mass of isotopes that are not in the net is moved to other isotopes (see `isotope_remap`). `comp_array` is not modified.
     filename : str
         The name of the file to write the composition to. If the file already exists, it will be overwritten.
+        An .npz or .npy extension writes a binary file instead of text (see
+        `composition_file.write_composition`).
+    isotopes : list of str, optional
+        The isotopes in `net`, if they have already been looked up with
+        `isos_from_net`. The default is to look them up.
     
     Returns
     -------
     None
     """
-    isotopes = isos_from_net(net)
-    for iso in comp_array.dtype.names[1:]:
-        if iso not in isotopes:
-            alt = alternate_iso(iso, isotopes, comp_array, use_max=True)
-            # dump this isotope's mass into the max isotope
-            print(f"Isotope {iso} not in composition array. Dumping into {alt}.")
-            if alt in comp_array.dtype.names:
-                comp_array[alt] += comp_array[iso]
-            else:
-                # update comp_array to have new column with the alternate isotope
-                comp_array = append_fields(comp_array, alt, comp_array[iso], usemask=False)
-    header = f"{len(comp_array)} {len(isotopes)}\n"
-    contents = header
-    for row in comp_array:
-        contents += f"{row['xq']:.15e}"
-        for iso in isotopes:
-            # if isotope is in composition array, add it to the line
-            # if not, add 0
-            if iso in comp_array.dtype.names:
-                contents += f" {row[iso]:.8e}"
-            else:
-                contents += " 0.00000000e+00"
-        contents += "\n"
-    with open(filename, 'w') as f:
-        f.write(contents.rstrip())
+    if isotopes is None:
+        isotopes = isos_from_net(net)
+    matrix, moved = net_matrix(comp_array, isotopes)
+    for iso, target, mass in moved:
+        print(f"Isotope {iso} not in net. Dumping its mass ({mass:.3e}) into {target}.")
+    write_composition(filename, Composition(comp_array['xq'], matrix, list(isotopes)))
@@ -0,0 +1,383 @@
+#! /usr/bin/env python3
+"""Read, validate, and compare composition files.
+
+Composition files are the text files written by `make_composition_file`: a
+header line with the number of rows and isotopes, then one line per row with
+xq and the mass fraction of every isotope of the net, in net order.
+
+Compositions can also be kept in binary files, which hold the same values
+and the names of the isotopes, for intermediate results that MESA never
+reads: `.npz` files (compressed) and `.npy` files, which can be
+memory-mapped. Every function here that reads a file takes all three
+formats, chosen by the extension.
+
+To check the output of a sweep, or compare two files, run:
+
+    python composition_file.py validate compositions/*.data [--net co_burn] [--tolerance 1e-6]
+    python composition_file.py diff old.data new.data [--net co_burn]
+
+`validate` checks the files in parallel and exits with status 1 if any has
+a problem.
+"""
+import argparse
+import sys
+import warnings
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, getpid, remove, replace
+
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured, unstructured_to_structured
+
+from instrument import stage
+
+Composition = namedtuple('Composition', ['xq', 'matrix', 'isotopes'])
+Composition.__doc__ = """A composition in net order.
+
+Attributes
+----------
+xq : np.ndarray
+    The fractional external mass coordinate of each row.
+matrix : np.ndarray
+    The mass fractions, with shape (len(xq), number of isotopes).
+isotopes : list of str or None
+    The isotopes of the columns of `matrix`, or `None` if not known.
+"""
+
+BINARY_EXTENSIONS = ('.npz', '.npy')
+
+def _read_binary(filename, mmap=False):
+    "Read an .npz or .npy file written by `write_composition`."
+    try:
+        if filename.endswith('.npz'):
+            with np.load(filename) as data:
+                return Composition(data['xq'], data['matrix'], data['isotopes'].tolist())
+        table = np.load(filename, mmap_mode='r' if mmap else None)
+    except (KeyError, EOFError) as e:
+        raise ValueError(f"{filename} is not a composition file: {e}") from None
+    names = table.dtype.names
+    if not names or names[0] != 'xq':
+        raise ValueError(f"{filename} is not a composition file: it has no xq field")
+    # a view of the table, so a memory-mapped file is not read here
+    return Composition(table['xq'], structured_to_unstructured(table[list(names[1:])]), list(names[1:]))
+
+def read_composition(filename, net=None, mmap=False):
+    """Read a composition file.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file: a text file, or an .npz or .npy file written by
+        `write_composition`.
+    net : str, optional
+        The net the file was written for. If given, the number of columns
+        must match the number of isotopes in the net, and the isotopes of a
+        binary file must be those of the net.
+    mmap : bool, optional
+        Memory-map an .npy file (read-only) rather than reading it. Ignored
+        for other files.
+
+    Returns
+    -------
+    Composition
+        `xq`, `matrix`, and `isotopes`, the isotopes of `net` or of a binary
+        file, in the order of the columns of `matrix`; `None` for a text file
+        without a net.
+
+    Raises
+    ------
+    ValueError
+        If the file does not hold as many values as its header says, or the
+        isotopes do not match `net`.
+    """
+    if filename.endswith(BINARY_EXTENSIONS):
+        composition = _read_binary(filename, mmap)
+        if net is not None:
+            from list_isos import isos_from_net
+            isotopes = isos_from_net(net)
+            if composition.isotopes != list(isotopes):
+                raise ValueError(f"{filename} does not have the isotopes of {net}")
+        return composition
+    with open(filename) as f:
+        header = f.readline().split()
+        try:
+            rows, num_isos = int(header[0]), int(header[1])
+        except (IndexError, ValueError):
+            raise ValueError(f"{filename} does not start with a '<rows> <isotopes>' header") from None
+        with warnings.catch_warnings():
+            # text that is not a number ends the parse with a warning (an
+            # error in later versions of NumPy)
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(f.read(), sep=' ')
+            except (DeprecationWarning, ValueError):
+                raise ValueError(f"{filename} has values that are not numbers") from None
+    if values.size != rows * (num_isos + 1):
+        raise ValueError(f"{filename} has {values.size} values, but its header says "
+                         f"{rows} rows of xq and {num_isos} isotopes")
+    values = values.reshape(rows, num_isos + 1)
+    isotopes = None
+    if net is not None:
+        from list_isos import isos_from_net
+        isotopes = isos_from_net(net)
+        if len(isotopes) != num_isos:
+            raise ValueError(f"{filename} has {num_isos} isotopes, but {net} has {len(isotopes)}")
+    return Composition(values[:, 0], values[:, 1:], isotopes)
+
+def write_composition(filename, composition):
+    """Write a composition to a file, replacing it atomically.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the file. Its extension picks the format: `.npz` for a
+        compressed NumPy archive, `.npy` for a structured array with the
+        field 'xq' and one field per isotope, which `read_composition` can
+        memory-map, and anything else for the text format MESA reads (see
+        `write_composition_matrix`).
+    composition : Composition
+        The composition. Binary files need its `isotopes`.
+
+    Returns
+    -------
+    None
+    """
+    xq, matrix, isotopes = composition
+    if not filename.endswith(BINARY_EXTENSIONS):
+        from composition_blend import write_composition_matrix
+        write_composition_matrix(xq, matrix, filename)
+        return
+    if isotopes is None or len(isotopes) != matrix.shape[1]:
+        raise ValueError(f"writing {filename} needs the name of each of the {matrix.shape[1]} isotopes")
+    # np.save and np.savez add their extension to names without it
+    tmp_name = f"{filename}.{getpid()}.tmp{filename[-4:]}"
+    try:
+        with stage('write'):
+            if filename.endswith('.npz'):
+                np.savez_compressed(tmp_name, xq=xq, matrix=matrix, isotopes=np.array(isotopes))
+            else:
+                table = np.column_stack((xq, matrix))
+                dtype = np.dtype([('xq', float)] + [(iso, float) for iso in isotopes])
+                np.save(tmp_name, unstructured_to_structured(table, dtype))
+    except BaseException:
+        try:
+            remove(tmp_name)
+        except OSError:
+            pass
+        raise
+    replace(tmp_name, filename)
+
+def check_composition(xq, matrix, num_isos=None, tolerance=1e-6):
+    """Check that a composition is physically sensible.
+
+    Parameters
+    ----------
+    xq : np.ndarray
+        The fractional external mass coordinate of each row.
+    matrix : np.ndarray
+        The mass fractions, with one row per xq.
+    num_isos : int, optional
+        The number of isotopes in the net, if known.
+    tolerance : float, optional
+        How far the mass fractions of a row may sum from 1. The default is
+        1e-6; the files store 9 significant figures per mass fraction.
+
+    Returns
+    -------
+    list of str
+        A description of each problem found; empty if there are none.
+    """
+    problems = []
+    if num_isos is not None and matrix.shape[1] != num_isos:
+        problems.append(f"{matrix.shape[1]} isotope columns, but the net has {num_isos}")
+    if not len(xq):
+        return problems + ["no rows"]
+    finite = np.isfinite(matrix).all(axis=1) & np.isfinite(xq)
+    if not finite.all():
+        bad = np.flatnonzero(~finite)
+        problems.append(f"{len(bad)} rows with NaN or infinite values (first: row {bad[0]})")
+    with np.errstate(invalid='ignore'):
+        negative = (matrix < 0).any(axis=1)
+        if negative.any():
+            bad = np.flatnonzero(negative)
+            problems.append(f"{len(bad)} rows with negative mass fractions (first: row {bad[0]})")
+        outside = (xq < 0) | (xq > 1)
+        if outside.any():
+            bad = np.flatnonzero(outside)
+            problems.append(f"{len(bad)} xq values outside [0, 1] (first: row {bad[0]}, xq = {xq[bad[0]]:g})")
+        decreasing = np.diff(xq) < 0
+        if decreasing.any():
+            bad = np.flatnonzero(decreasing) + 1
+            problems.append(f"xq decreases at {len(bad)} rows (first: row {bad[0]})")
+        error = np.abs(matrix.sum(axis=1) - 1)
+        unnormalized = error > tolerance
+        if unnormalized.any():
+            bad = np.flatnonzero(unnormalized)
+            worst = bad[np.argmax(error[bad])]
+            problems.append(f"{len(bad)} rows with mass fractions that do not sum to 1 within {tolerance:g} "
+                            f"(worst: row {worst}, off by {error[worst]:.3e})")
+    return problems
+
+def validate_file(filename, num_isos=None, tolerance=1e-6):
+    """Read a composition file and check it with `check_composition`.
+
+    Returns
+    -------
+    (str, list of str)
+        The file name and its problems. A file that cannot be read has that
+        as its only problem.
+    """
+    try:
+        xq, matrix, _ = read_composition(filename)
+    except (OSError, ValueError) as e:
+        return filename, [str(e)]
+    return filename, check_composition(xq, matrix, num_isos, tolerance)
+
+def _validate_file(args):
+    return validate_file(*args)
+
+def validate_files(filenames, net=None, tolerance=1e-6, processes=None):
+    """Check many composition files in parallel.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The files to check.
+    net : str, optional
+        The net every file was written for, to check the number of isotopes.
+    tolerance : float, optional
+        See `check_composition`.
+    processes : int, optional
+        The number of worker processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    list of (str, list of str)
+        Each file name and its problems, in the order given.
+    """
+    num_isos = None
+    if net is not None:
+        # resolve the net once, here, rather than in every worker
+        from list_isos import isos_from_net
+        num_isos = len(isos_from_net(net))
+    tasks = [(filename, num_isos, tolerance) for filename in filenames]
+    processes = min(processes or cpu_count(), max(len(tasks), 1))
+    if processes == 1:
+        return [_validate_file(task) for task in tasks]
+    # hand out files in batches to keep inter-process traffic low
+    chunksize = max(1, len(tasks) // (4 * processes))
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(_validate_file, tasks, chunksize=chunksize))
+
+def diff_compositions(xq_a, matrix_a, xq_b, matrix_b):
+    """Compare two compositions.
+
+    If the compositions have different xq grids, the second is linearly
+    interpolated onto the grid of the first.
+
+    Parameters
+    ----------
+    xq_a, matrix_a : np.ndarray
+        The first composition, as returned by `read_composition`.
+    xq_b, matrix_b : np.ndarray
+        The second composition, with the same isotopes.
+
+    Returns
+    -------
+    dict
+        'same_grid' : whether the xq grids are identical.
+        'max_xq_difference' : the largest difference in xq, if the grids have
+        the same number of rows, else `None`.
+        'max_difference' : the largest absolute difference in any mass
+        fraction.
+        'isotope_differences' : the largest absolute difference for each
+        isotope column.
+        'rows_differing' : the number of rows of the first composition with
+        any difference.
+
+    Raises
+    ------
+    ValueError
+        If the compositions have different numbers of isotopes.
+    """
+    if matrix_a.shape[1] != matrix_b.shape[1]:
+        raise ValueError(f"Cannot compare compositions with {matrix_a.shape[1]} "
+                         f"and {matrix_b.shape[1]} isotopes")
+    same_grid = xq_a.shape == xq_b.shape and np.array_equal(xq_a, xq_b)
+    if same_grid:
+        other = matrix_b
+    else:
+        other = np.column_stack([np.interp(xq_a, xq_b, column) for column in matrix_b.T])
+    difference = np.abs(matrix_a - other)
+    isotope_differences = difference.max(axis=0) if len(difference) else np.zeros(matrix_a.shape[1])
+    return {
+        'same_grid': same_grid,
+        'max_xq_difference': float(np.abs(xq_a - xq_b).max()) if xq_a.shape == xq_b.shape and len(xq_a) else None,
+        'max_difference': float(isotope_differences.max()) if len(isotope_differences) else 0.0,
+        'isotope_differences': isotope_differences,
+        'rows_differing': int((difference > 0).any(axis=1).sum()),
+    }
+
+def diff_files(filename_a, filename_b, net=None):
+    """Compare two composition files with `diff_compositions`.
+
+    Returns
+    -------
+    dict
+        As returned by `diff_compositions`, with 'isotope_differences' keyed
+        by isotope name if `net` is given (else by column number, from 1).
+    """
+    xq_a, matrix_a, isotopes = read_composition(filename_a, net)
+    xq_b, matrix_b, _ = read_composition(filename_b, net)
+    result = diff_compositions(xq_a, matrix_a, xq_b, matrix_b)
+    names = isotopes or [str(k + 1) for k in range(matrix_a.shape[1])]
+    result['isotope_differences'] = dict(zip(names, result['isotope_differences'].tolist()))
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Validate and compare composition files.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_validate = subparsers.add_parser('validate', help="check composition files for problems")
+    parser_validate.add_argument('files', nargs='+')
+    parser_validate.add_argument('--net', help="the net the files were written for")
+    parser_validate.add_argument('--tolerance', type=float, default=1e-6,
+                                 help="allowed error in the sum of each row's mass fractions (default: 1e-6)")
+    parser_validate.add_argument('--processes', type=int, default=None,
+                                 help="number of worker processes (default: number of CPUs)")
+
+    parser_diff = subparsers.add_parser('diff', help="compare two composition files")
+    parser_diff.add_argument('file_a')
+    parser_diff.add_argument('file_b')
+    parser_diff.add_argument('--net', help="the net the files were written for, to name the isotopes")
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'validate':
+        results = validate_files(args.files, args.net, args.tolerance, args.processes)
+        failed = 0
+        for filename, problems in results:
+            if problems:
+                failed += 1
+                print(f"{filename}:")
+                for problem in problems:
+                    print(f"  {problem}")
+        print(f"{len(results) - failed} of {len(results)} files passed.")
+        if failed:
+            sys.exit(1)
+    else:
+        try:
+            result = diff_files(args.file_a, args.file_b, args.net)
+        except (OSError, ValueError) as e:
+            sys.exit(f"Error: {e}")
+        if not result['same_grid']:
+            print("The xq grids differ; compared on the grid of the first file.")
+        if result['max_xq_difference'] is not None:
+            print(f"Largest xq difference: {result['max_xq_difference']:.3e}")
+        print(f"Largest mass fraction difference: {result['max_difference']:.3e} "
+              f"in {result['rows_differing']} rows")
+        for name, difference in result['isotope_differences'].items():
+            if difference > 0:
+                print(f"  {name:>8s} {difference:.3e}")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,174 @@
+"""Build a reference profile from an ensemble of MESA models.
+
+Instead of sampling one reference model, `ensemble_reference` loads many
+profiles (several at a time, in threads), interpolates each onto a shared
+grid in log xq, and combines them into a median or mean profile with
+percentile envelopes. The combined profile has the same layout as the one
+returned by `reference_profile`, so it can be passed to `modular_blend`.
+Each full profile is dropped as soon as it has been interpolated, so memory
+use is set by the grid, not by the size of the models.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+
+import numpy as np
+
+from instrument import stage
+
+STATISTICS = ('median', 'mean')
+
+def ensemble_grid(points=4000, xq_min=1e-12):
+    """Return a grid of xq values evenly spaced in log xq, ending at 1."""
+    return np.geomspace(xq_min, 1, points)
+
+def interpolate_profile(xqs, block, grid):
+    """Interpolate a profile onto a grid, linearly in log xq.
+
+    All isotopes are interpolated at once from a single binary search.
+    Grid points outside the profile take the composition of its nearest
+    zone.
+
+    Parameters
+    ----------
+    xqs : np.ndarray
+        The monotonically increasing, positive coordinate of each zone.
+    block : np.ndarray
+        The mass fractions, with shape (len(xqs), isotopes).
+    grid : np.ndarray
+        The coordinates to interpolate to.
+
+    Returns
+    -------
+    np.ndarray
+        The mass fractions at each grid point, with shape (len(grid),
+        isotopes).
+    """
+    if len(xqs) == 1:
+        return np.repeat(block, len(grid), axis=0)
+    log_xqs = np.log10(xqs)
+    log_grid = np.log10(grid)
+    right = np.clip(np.searchsorted(log_xqs, log_grid), 1, len(xqs) - 1)
+    left = right - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = (log_grid - log_xqs[left]) / (log_xqs[right] - log_xqs[left])
+    # zones of zero width take the outer zone's composition
+    weight = np.clip(np.nan_to_num(weight, nan=0.0), 0, 1)[:, None]
+    return block[left] * (1 - weight) + block[right] * weight
+
+def _load_interpolated(model_file, grid, snapshot=True):
+    """Read a profile and return its net, isotopes, and gridded mass fractions."""
+    from modular_composition import reference_profile
+    from profile_reader import read_profile
+
+    model = read_profile(model_file, snapshot=snapshot)
+    xqs, isos, block = reference_profile(model)
+    return model.header('net_name'), isos, interpolate_profile(xqs, block, grid)
+
+@stage('combine models')
+def ensemble_reference(model_files, grid=None, statistic='median', percentiles=(16, 84), threads=None,
+                       snapshot=True):
+    """Combine the composition profiles of many reference models.
+
+    Parameters
+    ----------
+    model_files : list of str
+        The MESA profiles of the models.
+    grid : np.ndarray, optional
+        The xq grid to combine the profiles on. The default is
+        `ensemble_grid()`.
+    statistic : str, optional
+        How to combine the models at each grid point, one of `STATISTICS`.
+        The default is 'median'. The result is normalized so every grid
+        point's mass fractions sum to 1.
+    percentiles : sequence of float, optional
+        The percentiles of the envelopes around the combined profile. The
+        default is (16, 84).
+    threads : int, optional
+        The number of profiles to read at a time. The default is the number
+        of CPUs.
+    snapshot : bool, optional
+        Passed on to `read_profile`. `False` neither uses nor writes the
+        binary snapshots next to the profiles.
+
+    Returns
+    -------
+    reference : tuple
+        The combined profile, as (xqs, isos, block) like `reference_profile`
+        returns. Isotopes are those of any model, in order of first
+        appearance; models without an isotope count as having none of it.
+    envelopes : dict
+        Maps each percentile to an array of mass fractions with the same
+        shape as `block`.
+    nets : list of str
+        The net of each model.
+    """
+    if statistic not in STATISTICS:
+        raise ValueError(f"Unknown statistic {statistic!r}; use one of {STATISTICS}")
+    if not model_files:
+        raise ValueError("An ensemble needs at least one model")
+    grid = ensemble_grid() if grid is None else np.asarray(grid, dtype=float)
+    nets = []
+    columns = {}
+    stack = np.zeros((len(model_files), len(grid), 0))
+    with ThreadPoolExecutor(threads or cpu_count()) as executor:
+        # each gridded model is copied into the stack as it arrives and then
+        # dropped, so only the stack is held
+        results = executor.map(lambda model_file: _load_interpolated(model_file, grid, snapshot), model_files)
+        for layer, (net, model_isos, gridded) in enumerate(results):
+            nets.append(net)
+            for iso in model_isos:
+                columns.setdefault(iso, len(columns))
+            if len(columns) > stack.shape[2]:
+                # new isotopes, which the models so far do not have; models
+                # of one ensemble rarely differ, so this is mostly the first
+                grown = np.zeros((len(model_files), len(grid), len(columns)))
+                grown[:, :, :stack.shape[2]] = stack
+                stack = grown
+            stack[layer][:, [columns[iso] for iso in model_isos]] = gridded
+            del gridded
+    isos = list(columns)
+
+    block = np.median(stack, axis=0) if statistic == 'median' else stack.mean(axis=0)
+    total = block.sum(axis=1, keepdims=True)
+    block = np.divide(block, total, out=block, where=total > 0)
+    envelopes = dict(zip(percentiles, np.percentile(stack, percentiles, axis=0)))
+    return (grid, isos, np.ascontiguousarray(block)), envelopes, nets
+
+def envelope_at(reference, envelopes, sample_xqs):
+    """Return the combined profile and its envelopes at sample locations.
+
+    Uses the grid point closest to each location, as `modular_blend` does.
+
+    Parameters
+    ----------
+    reference, envelopes
+        As returned by `ensemble_reference`.
+    sample_xqs : list of float
+        The sample locations.
+
+    Returns
+    -------
+    dict
+        Maps the name of the statistic ('central', or each percentile) to an
+        array of shape (len(sample_xqs), isotopes).
+    """
+    from modular_composition import nearest_zones
+
+    xqs, _, block = reference
+    zones = nearest_zones(xqs, sample_xqs)
+    return {'central': block[zones], **{percentile: envelope[zones] for percentile, envelope in envelopes.items()}}
+
+def write_envelope(filename, reference, envelopes, sample_xqs):
+    """Write the combined profile and its envelopes at sample locations as CSV.
+
+    The file has a header line with the columns statistic, xq, and each
+    isotope, and a row for each statistic at each sample location.
+    """
+    isos = reference[1]
+    values = envelope_at(reference, envelopes, sample_xqs)
+    with open(filename, 'w') as f:
+        f.write(','.join(['statistic', 'xq'] + isos) + '\n')
+        for k, sample_xq in enumerate(sample_xqs):
+            for name, rows in values.items():
+                label = name if name == 'central' else f'p{name:g}'
+                f.write(','.join([label, repr(float(sample_xq))] + [f'{value:.8e}' for value in rows[k]]) + '\n')
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+"""Read and edit MESA inlists (Fortran namelist files) without shMESA.
+
+Edits keep the layout and comments of the file and replace only the values
+that change, so the result looks like a hand-edited inlist.
+
+If called as an executable, change the values of keys in an inlist, like
+`shmesa change`:
+
+    python inlist.py inlist_wd_builder initial_mass 0.6 save_model_filename "'M0P6.mod'"
+"""
+import re
+from os import chmod, getpid, replace, stat
+from os.path import abspath, basename, dirname, join
+from sys import argv, exit
+
+from instrument import stage
+
+# an assignment inside a namelist: indentation, key (possibly with an array
+# index), the equals sign with its spacing, and the value
+ASSIGNMENT = re.compile(r"^(\s*)([A-Za-z_]\w*(?:\([^)]*\))?)(\s*=[ \t]*)(.*?)(\s*)$")
+
+def fortran_value(value):
+    """Return the Fortran literal for a Python value.
+
+    Parameters
+    ----------
+    value : bool, int, float, or str
+        The value. Strings are quoted.
+
+    Returns
+    -------
+    str
+    """
+    if isinstance(value, bool):
+        return '.true.' if value else '.false.'
+    if isinstance(value, (int, float)):
+        return repr(value).replace('e', 'd')
+    return "'" + str(value).replace("'", "''") + "'"
+
+def parse_value(text):
+    """Return the Python value of a Fortran literal.
+
+    Parameters
+    ----------
+    text : str
+        The literal, like `.true.`, `2d8`, or `'name'`.
+
+    Returns
+    -------
+    bool, int, float, str, or None
+        `None` if `text` is empty. Text that is not a recognized literal is
+        returned unchanged.
+    """
+    text = text.strip()
+    if not text:
+        return None
+    if text[0] in "'\"" and text[-1] == text[0] and len(text) > 1:
+        return text[1:-1].replace(text[0] * 2, text[0])
+    lowered = text.lower()
+    if lowered in ('.true.', 't', '.t.'):
+        return True
+    if lowered in ('.false.', 'f', '.f.'):
+        return False
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(lowered.replace('d', 'e'))
+    except ValueError:
+        return text
+
+def split_comment(line):
+    """Split a line into its code and its trailing `!` comment.
+
+    Exclamation marks inside quoted strings do not start a comment.
+
+    Returns
+    -------
+    code : str
+    comment : str
+        The comment, including the `!` and any whitespace before it, or an
+        empty string.
+    """
+    quote = None
+    for i, c in enumerate(line):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == '!':
+            code = line[:i].rstrip()
+            return code, line[len(code):]
+    return line, ''
+
+def read_inlist(filename):
+    """Return the values set in each namelist of an inlist.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the inlist file.
+
+    Returns
+    -------
+    dict of dict
+        Maps each namelist name (like `star_job`) to a dictionary of its keys
+        and values, as returned by `parse_value`. Keys keep any array index,
+        like `x_ctrl(1)`.
+    """
+    namelists = {}
+    current = None
+    with open(filename) as f:
+        for line in f:
+            code = split_comment(line.rstrip('\n'))[0].strip()
+            if not code:
+                continue
+            if code.startswith('&'):
+                current = namelists.setdefault(code[1:].split()[0].lower(), {})
+            elif code.startswith('/'):
+                current = None
+            elif current is not None:
+                match = ASSIGNMENT.match(code)
+                if match:
+                    current[match.group(2)] = parse_value(match.group(4))
+    return namelists
+
+def update_inlist_text(text, changes):
+    """Return the text of an inlist with the values of some keys changed.
+
+    Parameters
+    ----------
+    text : str
+        The contents of the inlist.
+    changes : dict
+        Maps keys to their new Python values (see `fortran_value`). Keys are
+        matched case-insensitively, and every assignment to a key is changed.
+
+    Returns
+    -------
+    str
+
+    Raises
+    ------
+    KeyError
+        If a key is not assigned anywhere in the inlist.
+    """
+    new_values = {key.lower(): fortran_value(value) for key, value in changes.items()}
+    found = set()
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        code, comment = split_comment(line)
+        match = ASSIGNMENT.match(code)
+        if match and match.group(2).lower() in new_values:
+            key = match.group(2).lower()
+            found.add(key)
+            indent, name, equals = match.group(1, 2, 3)
+            # keep at least one space between the value and a trailing comment
+            if comment and not comment[0].isspace():
+                comment = ' ' + comment
+            lines[i] = f"{indent}{name}{equals}{new_values[key]}{comment}"
+    missing = set(new_values) - found
+    if missing:
+        raise KeyError(f"Not set in inlist: {', '.join(sorted(missing))}")
+    return '\n'.join(lines)
+
+@stage('update inlist')
+def change_inlist(filename, changes, output=None):
+    """Change the values of keys in an inlist with a single atomic write.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the inlist file to read.
+    changes : dict
+        Maps keys to their new Python values; see `update_inlist_text`.
+    output : str, optional
+        The name of the file to write. The default is to overwrite
+        `filename`. The file is written to a temporary file first and then
+        renamed, so other processes never see a partially written inlist.
+        It is not rewritten if its contents would not change.
+
+    Returns
+    -------
+    str
+        The name of the file written.
+    """
+    output = output or filename
+    with open(filename) as f:
+        text = f.read()
+    new_text = update_inlist_text(text, changes)
+    try:
+        with open(output) as f:
+            if f.read() == new_text:
+                return output
+    except FileNotFoundError:
+        pass
+    tmp_name = join(dirname(abspath(output)), f".{basename(output)}.{getpid()}.tmp")
+    with open(tmp_name, 'w') as f:
+        f.write(new_text)
+    chmod(tmp_name, stat(filename).st_mode & 0o7777)
+    replace(tmp_name, output)
+    return output
+
+if __name__ == "__main__":
+    if len(argv) < 4 or len(argv) % 2:
+        print("Usage: python inlist.py <inlist> <key> <value> [<key> <value> ...]")
+        exit(1)
+    # values are given as Fortran literals, as they would be written in the file
+    change_inlist(argv[1], {key: parse_value(value) for key, value in zip(argv[2::2], argv[3::2])})
@@ -0,0 +1,285 @@
+#! /usr/bin/env python3
+"""Time the stages of composition builds.
+
+Code that does a distinct step of a build marks it with `stage`:
+
+    with stage('blend'):
+        ...
+
+A stage only costs anything inside a `build_record`, which collects the wall
+time, CPU time, and peak memory of every stage of one build into a record (a
+dict that can be saved as JSON). Stages inside other stages are named by
+their path, like 'combine models/read profile', and the times of a stage that
+is entered more than once, like each chunk of a streamed build, are added up.
+Given a `profile_dir`, the whole build is also run under cProfile and
+tracemalloc, and their results are saved there.
+
+The builders and sweeps take `--timings FILE`, which appends each build's
+record to a JSON Lines file, and `--profile DIR`. To summarize a file of
+records, such as the one written by a sweep, run:
+
+    python instrument.py timings.jsonl [--json]
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from datetime import datetime, timezone
+from os import getpid, makedirs
+from os.path import basename, join
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak memory is then not recorded
+    resource = None
+
+# the record of the build in progress, the path of the stage in progress,
+# and the traced memory peaks of that stage's finished children (see `stage`)
+_record = ContextVar('record', default=None)
+_path = ContextVar('path', default=())
+_child_peaks = ContextVar('child_peaks', default=None)
+
+def peak_rss_mb():
+    "Return the peak resident memory of this process so far in MB, or `None` if unknown."
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+def _start_traced_peak():
+    """Start measuring the traced memory peak of a stage, if tracemalloc is on.
+
+    tracemalloc keeps a single peak, so it is reset here and the peak so far
+    is handed to the enclosing stage, which would otherwise lose it.
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    outer = _child_peaks.get()
+    if outer is not None:
+        outer.append(tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    return _child_peaks.set([])
+
+def _stop_traced_peak(token):
+    "Return the traced memory peak of a stage in MB, and hand it to the enclosing stage."
+    children = _child_peaks.get()
+    _child_peaks.reset(token)
+    peak = max([tracemalloc.get_traced_memory()[1]] + children)
+    outer = _child_peaks.get()
+    if outer is not None:
+        outer.append(peak)
+    return peak / (1 << 20)
+
+class stage:
+    """Time a stage of the build in progress.
+
+    Use as a context manager (`with stage('write'):`) or as a decorator
+    (`@stage('load model')`). Does nothing outside `build_record`, and as a
+    decorator costs a single context variable lookup then, so library code
+    can mark its stages unconditionally.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, like 'blend' or 'write'.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def __call__(self, func):
+        name = self.name
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            if _record.get() is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def __enter__(self):
+        record = _record.get()
+        if record is None:
+            return self
+        path = _path.get() + (self.name,)
+        self._start = (record, path, _path.set(path), _start_traced_peak(),
+                       time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._start is None:
+            return
+        record, path, path_token, peak_token, wall, cpu = self._start
+        self._start = None
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        entry = record['stages'].setdefault('/'.join(path), {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+        entry['calls'] += 1
+        entry['wall_s'] += wall
+        entry['cpu_s'] += cpu
+        rss = peak_rss_mb()
+        if rss is not None:
+            # a high-water mark, so the value at the last exit is the largest
+            entry['peak_rss_mb'] = rss
+        if peak_token is not None:
+            entry['peak_traced_mb'] = max(entry.get('peak_traced_mb', 0.0), _stop_traced_peak(peak_token))
+        _path.reset(path_token)
+
+@contextmanager
+def build_record(name, profile_dir=None, **info):
+    """Collect the stages of a build into a record.
+
+    Parameters
+    ----------
+    name : str
+        What is being built, usually the name of the output file.
+    profile_dir : str, optional
+        If given, the build is also run under cProfile and tracemalloc. The
+        profile is saved as `<name>.prof` in this directory (without any
+        directories or .data extension of `name`; read it with
+        `pstats` or snakeviz), and the 25 lines that allocated the most
+        memory as `<name>.tracemalloc.txt`. Per-stage traced memory peaks
+        are then recorded too.
+    **info
+        Other JSON-serializable values to put in the record.
+
+    Yields
+    ------
+    dict
+        The record. It has the keys 'build' (`name`), 'started' (a UTC
+        timestamp), 'pid', any `info`, and 'stages', which maps each stage
+        to its number of calls and total 'wall_s' and 'cpu_s' and its
+        'peak_rss_mb'. When the build finishes, its own 'wall_s', 'cpu_s',
+        and 'peak_rss_mb' are added, and so are the names of the 'profile'
+        and 'tracemalloc' files, if any.
+    """
+    record = {'build': name, 'started': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'pid': getpid(), **info, 'stages': {}}
+    record_token = _record.set(record)
+    path_token = _path.set(())
+    profiler = None
+    started_tracing = False
+    if profile_dir is not None:
+        import cProfile
+        makedirs(profile_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+    peak_token = _start_traced_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+        record['peak_rss_mb'] = peak_rss_mb()
+        if peak_token is not None:
+            record['peak_traced_mb'] = _stop_traced_peak(peak_token)
+        if profiler is not None:
+            profiler.disable()
+            base = join(profile_dir, basename(name).removesuffix('.data'))
+            record['profile'] = f'{base}.prof'
+            profiler.dump_stats(record['profile'])
+            record['tracemalloc'] = f'{base}.tracemalloc.txt'
+            with open(record['tracemalloc'], 'w') as f:
+                for line in tracemalloc.take_snapshot().statistics('lineno')[:25]:
+                    f.write(f'{line}\n')
+            if started_tracing:
+                tracemalloc.stop()
+        _path.reset(path_token)
+        _record.reset(record_token)
+
+def annotate(**info):
+    "Add JSON-serializable values to the record of the build in progress, if any."
+    record = _record.get()
+    if record is not None:
+        record.update(info)
+
+def append_records(filename, records):
+    "Append records to a JSON Lines file, one line per record."
+    with open(filename, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+def read_records(filename):
+    "Read the records in a JSON Lines file."
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize_records(records):
+    """Add up the stages of many build records.
+
+    Parameters
+    ----------
+    records : list of dict
+        Records from `build_record`.
+
+    Returns
+    -------
+    list of dict
+        One entry per stage, from the one that took the most wall time to
+        the least, with the number of 'builds' it appeared in, its total
+        'calls', 'wall_s' and 'cpu_s', its 'mean_wall_s' and 'max_wall_s'
+        per build, the largest 'peak_rss_mb' at its end, and its 'share' of
+        the builds' total wall time. Time spent outside any stage, such as
+        importing modules, is listed as the stage '(outside stages)'.
+    """
+    total = sum(record['wall_s'] for record in records)
+    stages = {}
+    for record in records:
+        outside = {'calls': 1, 'wall_s': record['wall_s'], 'cpu_s': record['cpu_s']}
+        for name, entry in record['stages'].items():
+            if '/' not in name:
+                outside['wall_s'] -= entry['wall_s']
+                outside['cpu_s'] -= entry['cpu_s']
+        for name, entry in [*record['stages'].items(), ('(outside stages)', outside)]:
+            summary = stages.setdefault(name, {'stage': name, 'builds': 0, 'calls': 0, 'wall_s': 0.0,
+                                               'cpu_s': 0.0, 'max_wall_s': 0.0, 'peak_rss_mb': None})
+            summary['builds'] += 1
+            summary['calls'] += entry['calls']
+            summary['wall_s'] += entry['wall_s']
+            summary['cpu_s'] += entry['cpu_s']
+            summary['max_wall_s'] = max(summary['max_wall_s'], entry['wall_s'])
+            if entry.get('peak_rss_mb') is not None:
+                summary['peak_rss_mb'] = max(summary['peak_rss_mb'] or 0.0, entry['peak_rss_mb'])
+    for summary in stages.values():
+        summary['mean_wall_s'] = summary['wall_s'] / summary['builds']
+        summary['share'] = summary['wall_s'] / total if total > 0 else 0.0
+    return sorted(stages.values(), key=lambda summary: -summary['wall_s'])
+
+def format_summary(records):
+    "Return a table of `summarize_records(records)` as text."
+    lines = [f"{len(records)} records, {sum(record['wall_s'] for record in records):.3f} s in total",
+             f"{'stage':<32s} {'builds':>6s} {'calls':>7s} {'wall s':>9s} {'cpu s':>9s} "
+             f"{'mean ms':>9s} {'max ms':>9s} {'share':>6s} {'peak MB':>8s}"]
+    for summary in summarize_records(records):
+        peak = '' if summary['peak_rss_mb'] is None else f"{summary['peak_rss_mb']:.0f}"
+        lines.append(f"{summary['stage']:<32s} {summary['builds']:6d} {summary['calls']:7d} "
+                     f"{summary['wall_s']:9.3f} {summary['cpu_s']:9.3f} {summary['mean_wall_s'] * 1e3:9.2f} "
+                     f"{summary['max_wall_s'] * 1e3:9.2f} {summary['share']:6.1%} {peak:>8s}")
+    return '\n'.join(lines)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Summarize the per-stage timings of builds.")
+    parser.add_argument('files', nargs='+', help="JSON Lines files written with --timings")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args(argv[1:])
+
+    records = [record for filename in args.files for record in read_records(filename)]
+    if args.json:
+        print(json.dumps(summarize_records(records), indent=2))
+    else:
+        print(format_summary(records))
+
+if __name__ == "__main__":
+    main(sys.argv)
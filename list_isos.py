@@ -1,43 +1,86 @@
 #! /usr/bin/env python3
-from os import environ
+from os import environ, getpid, makedirs, replace, scandir, stat
 from sys import argv
-from os.path import join
-import re
+from os.path import expanduser, isfile, join
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+
+import numpy as np
+
+from instrument import stage
 
 ATOMIC_SYMBOLS = ['neut', 'h', 'he', 'li', 'be', 'b', 'c', 'n', 'o', 'f', 'ne', 'na', 'mg', 'al', 'si', 'p', 's', 'cl', 'ar', 'k', 'ca', 'sc', 'ti', 'v', 'cr', 'mn', 'fe', 'co', 'ni', 'cu', 'zn', 'ga', 'ge', 'as', 'se', 'br', 'kr', 'rb', 'sr', 'y', 'zr', 'nb', 'mo', 'tc', 'ru', 'rh', 'pd', 'ag', 'cd', 'in', 'sn', 'sb', 'te', 'i', 'xe', 'cs', 'ba', 'la', 'ce', 'pr', 'nd', 'pm', 'sm', 'eu', 'gd', 'tb', 'dy', 'ho', 'er', 'tm', 'yb', 'lu', 'hf', 'ta', 'w', 're', 'os', 'ir', 'pt', 'au', 'hg', 'tl', 'pb', 'bi', 'po', 'at', 'rn', 'fr', 'ra', 'ac', 'th', 'pa', 'u', 'np', 'pu', 'am', 'cm', 'bk', 'cf', 'es', 'fm', 'md', 'no', 'lr', 'rf', 'db', 'sg', 'bh', 'hs', 'mt', 'ds', 'rg', 'cn', 'nh', 'fl', 'mc', 'lv', 'ts', 'og']
 
+_Z_BY_SYMBOL = {symbol: z for z, symbol in enumerate(ATOMIC_SYMBOLS)}
+
 def z_to_symbol(z):
     return ATOMIC_SYMBOLS[z]
 
 def symbol_to_z(symbol):
-    return ATOMIC_SYMBOLS.index(symbol)
+    try:
+        return _Z_BY_SYMBOL[symbol]
+    except KeyError:
+        raise ValueError(f"{symbol!r} is not an atomic symbol") from None
 
 NETS_DIR = join(environ['MESA_DIR'], 'data', 'net_data', 'nets')
-def isos_from_net(net_name):
-    """Return a list of isotopes from a net file
+# resolved isotope lists are kept on disk between runs, keyed by the net file
+# and the modification times of every file it includes
+CACHE_DIR = environ.get('WD_BUILDER_CACHE_DIR', join(expanduser('~'), '.cache', 'wd-profile-builder'))
+NET_CACHE_FILE = join(CACHE_DIR, 'nets.json')
+
+def net_path(net_name):
+    """Return the path to a net file
     
     Parameters
     ----------
     net_name : str
-        The name of the net file to read, with or without the .net extension
+        The name of the net file, with or without the .net extension
         
     Returns
     -------
-    list of str
-        A list of isotopes in the net file, sorted by atomic number and mass number
+    str
+        The path to the net file in `NETS_DIR`
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no such net file.
     """
-    # remove the .net extension; will try with and without it later
+    # remove the .net extension; will try with and without it
     net_name = net_name.replace('.net', '')
     # normal nets live in a file with the form NAME.net
-    try:
-        with open(join(NETS_DIR, net_name + '.net')) as f:
-            lines = [line.strip() for line in f.read().rstrip().split('\n')]
+    path = join(NETS_DIR, net_name + '.net')
+    if isfile(path):
+        return path
     # some pseudo-nets not intended to be used on their own don't have the .net
     # extension
-    except FileNotFoundError:
-        with open(join(NETS_DIR, net_name)) as f:
-            lines = [line.strip() for line in f.read().rstrip().split('\n')]
+    path = join(NETS_DIR, net_name)
+    if isfile(path):
+        return path
+    raise FileNotFoundError(f"No net file for {net_name} in {NETS_DIR}")
+
+def parse_net(path):
+    """Return the isotopes and included nets named in a net file
+    
+    Included nets are not followed; see `isos_from_net` for that.
+
+    Parameters
+    ----------
+    path : str
+        The path to the net file
+        
+    Returns
+    -------
+    isos : list of str
+        The isotopes explicitly added in the file, in the order they appear
+    includes : list of str
+        The names of the included net files, without the .net extension
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f.read().rstrip().split('\n')]
     isos = []
+    includes = []
 
     # go line by line to find all explicitly mentioned isotopes
     in_isos = False
@@ -74,32 +117,355 @@ def isos_from_net(net_name):
         elif "add_iso" in line:
             if '(' in line and ')' in line:
                 isos.append(line.split('(')[1].split(')')[0].split(',')[0])
-        # if we find an include statement, recursively add isotopes from the
-        # included net file
+        # if we find an include statement, remember the included net file
         elif line.startswith('include'):
             try:
-                new_net = line.split()[1].replace("'", "").replace('"', '').replace('.net', '')
-                isos.extend(isos_from_net(new_net))
+                includes.append(line.split()[1].replace("'", "").replace('"', '').replace('.net', ''))
             except IndexError as e:
                 print("Could not parse include line in net file:")
                 print(line)
                 raise e
+    return isos, includes
+
+# isotopes MESA names without a mass number
+SPECIAL_ISOTOPES = {'neut': (0, 1), 'prot': (1, 1)}
+
+def symbol_to_z_a(iso):
+    """Take an isotope string and return a tuple of (Z, A)
+    
+    Z is atomic number (0 for neutrons) and A is mass number. 'prot' is a
+    proton, like h1.
+
+    Raises
+    ------
+    ValueError
+        If `iso` is not the name of an isotope.
+    """
+    if iso in SPECIAL_ISOTOPES:
+        return SPECIAL_ISOTOPES[iso]
+    symbol = iso.rstrip('0123456789')
+    if symbol == iso or symbol not in _Z_BY_SYMBOL:
+        raise ValueError(f"{iso!r} is not an isotope")
+    return _Z_BY_SYMBOL[symbol], int(iso[len(symbol):])
+
+# the isotope table: every isotope seen so far gets a small integer id, and
+# its Z and A are kept in arrays indexed by id, so the properties of many
+# isotopes can be looked up at once with `isotope_ids`. The table is filled
+# lazily rather than precomputed: names are open-ended (any symbol with any
+# mass number, plus neut and prot), and listing every plausible one would
+# cost each command-line run tens of thousands of entries at import. A name
+# is parsed once, the first time it is seen; after that its id is one dict
+# lookup and its Z and A are array indexing
+_iso_ids = {}
+_iso_names = []
+_iso_z = np.zeros(256, dtype=np.int16)
+_iso_a = np.zeros(256, dtype=np.int16)
+
+def _add_isotope(iso):
+    global _iso_z, _iso_a
+    z, a = symbol_to_z_a(iso)
+    k = len(_iso_names)
+    if k == len(_iso_z):
+        _iso_z = np.concatenate([_iso_z, np.zeros_like(_iso_z)])
+        _iso_a = np.concatenate([_iso_a, np.zeros_like(_iso_a)])
+    _iso_z[k] = z
+    _iso_a[k] = a
+    _iso_names.append(iso)
+    _iso_ids[iso] = k
+    return k
+
+def isotope_id(iso):
+    """Return the id of an isotope in the isotope table, adding it if needed.
+
+    Ids are only meaningful within one process.
+
+    Raises
+    ------
+    ValueError
+        If `iso` is not the name of an isotope.
+    """
+    try:
+        return _iso_ids[iso]
+    except KeyError:
+        return _add_isotope(iso)
+
+def isotope_ids(isos):
+    """Return the ids of isotopes in the isotope table, as an array
+
+    Names already in the table cost one dict lookup each; only names not
+    seen before are parsed and added.
+
+    Parameters
+    ----------
+    isos : sequence of str
+        The isotope names
+
+    Returns
+    -------
+    np.ndarray of int
+        The id of each isotope; index `isotope_z` and `isotope_a` with it
+    """
+    get = _iso_ids.get
+    return np.fromiter((k if (k := get(iso)) is not None else _add_isotope(iso) for iso in isos),
+                       dtype=np.intp, count=len(isos))
+
+def isotope_z(ids):
+    "Return the atomic numbers of the isotopes with the given ids."
+    return _iso_z[:len(_iso_names)][ids]
+
+def isotope_a(ids):
+    "Return the mass numbers of the isotopes with the given ids."
+    return _iso_a[:len(_iso_names)][ids]
+
+def isotope_name(ids):
+    "Return the name of the isotope with an id, or a list of names for an array of ids."
+    if np.ndim(ids):
+        return [_iso_names[k] for k in ids]
+    return _iso_names[ids]
+
+def sort_isos(isos):
+    """Return isotopes without duplicates, sorted by atomic number and mass number
+
+    Isotopes with the same Z and A (h1 and prot) are sorted by name.
+    """
+    isos = sorted(set(isos))
+    ids = isotope_ids(isos)
+    # lexsort is stable, so ties stay in name order
+    return [isos[k] for k in np.lexsort((isotope_a(ids), isotope_z(ids)))]
+
+def _deps_unchanged(deps):
+    "Return whether none of the files in `deps`, (path, mtime_ns) pairs, has changed"
+    try:
+        return all(stat(dep).st_mtime_ns == mtime_ns for dep, mtime_ns in deps)
+    except OSError:
+        return False
+
+# resolved nets by path; an entry is used while none of its deps has changed
+_resolved = {}
+
+def _resolve_net(path):
+    """Return the sorted isotopes of a net file and of everything it includes
+
+    Memoized on the path, and used only while neither the net file nor any
+    net it includes has been modified, so every net in an include graph is
+    parsed at most once per process until one of them changes.
+
+    Returns
+    -------
+    isos : tuple of str
+        The isotopes, sorted by atomic number and mass number
+    deps : tuple of (str, int)
+        The path and modification time of every net file the result depends
+        on, including `path` itself
+    """
+    resolved = _resolved.get(path)
+    if resolved is not None and _deps_unchanged(resolved[1]):
+        return resolved
+    # read the modification time first, so an edit made while parsing
+    # leaves the entry stale rather than hiding the edit
+    deps = {path: stat(path).st_mtime_ns}
+    isos, includes = parse_net(path)
+    for include in includes:
+        include_isos, include_deps = _resolve_net(net_path(include))
+        isos.extend(include_isos)
+        deps.update(include_deps)
+    # remove duplicates and sort in ascending (Z, A)
+    resolved = _resolved[path] = tuple(sort_isos(isos)), tuple(deps.items())
+    return resolved
 
-    # sort first by atomic number and then by mass number;
-    # create a helper function to do this. Can't [easily] use a lambda because
-    # the neutron is a special case
-    def symbol_to_z_a(iso):
-        """Take an isotope string and return a tuple of (Z, A)
+_disk_cache = None
+
+def _load_disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        try:
+            with open(NET_CACHE_FILE) as f:
+                _disk_cache = json.load(f)
+        except (OSError, ValueError):
+            _disk_cache = {}
+    return _disk_cache
+
+def _store_disk_cache(path, isos, deps):
+    """Add one resolved net to the on-disk cache, merging with other processes"""
+    cache = _load_disk_cache()
+    cache[path] = {'deps': [list(dep) for dep in deps], 'isos': list(isos)}
+    try:
+        makedirs(CACHE_DIR, exist_ok=True)
+        # pick up entries other processes wrote since we loaded the cache
+        try:
+            with open(NET_CACHE_FILE) as f:
+                cache = {**json.load(f), **cache}
+        except (OSError, ValueError):
+            pass
+        # write to a temporary file and rename so readers never see a
+        # partially written cache
+        tmp_name = f"{NET_CACHE_FILE}.{getpid()}.tmp"
+        with open(tmp_name, 'w') as f:
+            json.dump(cache, f)
+        replace(tmp_name, NET_CACHE_FILE)
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+# whether resolved nets are saved to NET_CACHE_FILE; see `memory_only`
+_persist = ContextVar('persist', default=True)
+
+@contextmanager
+def memory_only():
+    """Keep the nets resolved inside this block out of `NET_CACHE_FILE`
+
+    They are still memoized in this process, and fresh entries already on
+    disk are still used, but nothing is written, so library code that must
+    not touch the disk can resolve nets.
+    """
+    token = _persist.set(False)
+    try:
+        yield
+    finally:
+        _persist.reset(token)
+
+def _net_isos_and_deps(path):
+    "Return the isotopes of a net file and its deps, from a cache if none of them changed"
+    entry = _load_disk_cache().get(path)
+    if entry is not None and _deps_unchanged(entry['deps']):
+        return entry['isos'], entry['deps']
+    isos, deps = _resolve_net(path)
+    if _persist.get():
+        _store_disk_cache(path, isos, deps)
+    return isos, deps
+
+@stage('parse net')
+def isos_from_net(net_name):
+    """Return a list of isotopes from a net file
+    
+    Results are cached in memory and on disk (see `NET_CACHE_FILE`). A cached
+    list is used only if neither the net file nor any net it includes has
+    been modified since it was stored.
+
+    Parameters
+    ----------
+    net_name : str
+        The name of the net file to read, with or without the .net extension
         
-        Z is atomic number (0 for neutrons) and A is mass number"""
-        if iso == 'neut':
-            return 0, 1
-        return (symbol_to_z(re.split(r'(\d+)', iso)[0]), int(re.split(r'(\d+)', iso)[1]))
-    # remove duplicates
-    isos = list(set(isos))
-    # sort in ascending (Z, A)
-    isos.sort(key=symbol_to_z_a)
-    return isos
+    Returns
+    -------
+    list of str
+        A list of isotopes in the net file, sorted by atomic number and mass number
+    """
+    return list(_net_isos_and_deps(net_path(net_name))[0])
+
+def net_names():
+    "Return the names of the net files in `NETS_DIR`, without the .net extension, sorted."
+    return sorted(entry.name[:-len('.net')] for entry in scandir(NETS_DIR)
+                  if entry.name.endswith('.net') and entry.is_file())
+
+_coverage = {}
+
+def net_coverage():
+    """Return an index of which isotopes every net in `NETS_DIR` contains
+
+    Built on first use and rebuilt when a net file is added or removed, or
+    when any net file or file it includes has been modified since (the same
+    modification times `isos_from_net` checks). Each net's isotopes come
+    from the net caches when it has not changed; nets that cannot be read
+    are left out.
+
+    Returns
+    -------
+    names : list of str
+        The names of the nets, from smallest to largest, and by name among
+        nets of the same size
+    sizes : np.ndarray of int
+        The number of isotopes in each net
+    members : np.ndarray of bool
+        An array of shape (len(names), number of isotopes in the table),
+        where `members[i, k]` says whether net i contains the isotope with
+        id k
+    """
+    names = tuple(net_names())
+    if _coverage.get('names') != names or not _deps_unchanged(_coverage['deps']):
+        nets = []
+        deps = {}
+        for name in names:
+            try:
+                isos, net_deps = _net_isos_and_deps(net_path(name))
+                nets.append((name, isotope_ids(isos)))
+            except (OSError, ValueError, IndexError):
+                continue
+            deps.update(net_deps)
+        nets.sort(key=lambda net: (len(net[1]), net[0]))
+        members = np.zeros((len(nets), len(_iso_names)), dtype=bool)
+        for row, (_, ids) in zip(members, nets):
+            row[ids] = True
+        _coverage.update(names=names, deps=list(deps.items()), index=([name for name, _ in nets],
+                                             np.array([len(ids) for _, ids in nets], dtype=int), members))
+    return _coverage['index']
+
+def nets_covering(isos):
+    """Return the nets in `NETS_DIR` that contain every isotope given
+
+    Parameters
+    ----------
+    isos : sequence of str
+        The isotopes, such as those of a composition
+
+    Returns
+    -------
+    list of str
+        The names of the nets, from smallest to largest
+    """
+    names, _, members = net_coverage()
+    ids = isotope_ids(isos)
+    if len(ids) and ids.max() >= members.shape[1]:
+        # an isotope no net has
+        return []
+    return [names[i] for i in np.flatnonzero(members[:, ids].all(axis=1))]
+
+def smallest_covering_net(isos):
+    """Return the smallest net in `NETS_DIR` that contains every isotope given
+
+    A composition written for this net keeps the mass of every isotope
+    where it is, rather than moving it to another isotope.
+
+    Returns
+    -------
+    str or None
+        The name of the net, or `None` if no net contains them all
+    """
+    nets = nets_covering(isos)
+    return nets[0] if nets else None
+
+def resolve_net(net, isos, default=None):
+    """Return a net, picking the smallest one that fits if it is 'auto'
+
+    Parameters
+    ----------
+    net : str
+        The name of a net, or 'auto'
+    isos : sequence of str
+        The isotopes of the composition, used if `net` is 'auto'
+    default : str, optional
+        The net to use if `net` is 'auto' and no net contains every isotope
+
+    Returns
+    -------
+    str
+        The name of the net
+
+    Raises
+    ------
+    ValueError
+        If `net` is 'auto', no net contains every isotope, and there is no
+        `default`.
+    """
+    if net != 'auto':
+        return net
+    covering = smallest_covering_net(isos)
+    if covering is not None:
+        return covering
+    if default is None:
+        raise ValueError(f"No net in {NETS_DIR} contains all of {', '.join(isos)}")
+    return default
 
 if __name__ == "__main__":
     # if called as an executable, print the isotopes in the net file
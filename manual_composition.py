@@ -1,80 +1,280 @@
 import sys
+from itertools import islice
 import numpy as np
-import pandas as pd
-import subprocess
-from composition_blend import blend_comps, make_composition_file
+from numpy.lib.recfunctions import unstructured_to_structured
+from build_cache import cached_build, evict, manual_key
+from composition_blend import blend_matrix, blend_stream, write_composition_chunks
+from inlist import change_inlist
+from instrument import stage
 from list_isos import isos_from_net
 
-if len(sys.argv) != 4:
-    print("Error: Must provide 4 args-- python manual_composition.py <initial_mass> <csv_file> <network.net>")
-    sys.exit(1)
+def composition_name(initial_mass):
+    "Return the base name of the composition and model files for a mass."
+    initial_mass = str(initial_mass)
+    return f'M{initial_mass[0]}P{initial_mass[2:]}_manual'
 
-initial_mass = sys.argv[1]
-csv_file = sys.argv[2]
-net_name = sys.argv[3]
+def read_csv_table(csv_file):
+    """Read a CSV file of layer compositions.
 
-# Read the CSV file & make sure it has an xq column
-df = pd.read_csv(csv_file)
-if 'xq' not in df.columns:
-    print("Error: CSV must have an 'xq' column")
-    sys.exit(1)
+    Parameters
+    ----------
+    csv_file : str
+        The name of the CSV file. The first line holds the column names.
 
+    Returns
+    -------
+    columns : list of str
+        The column names.
+    table : np.ndarray
+        The values, with one row per layer and one column per name.
+    """
+    return csv_columns(csv_file), np.loadtxt(csv_file, delimiter=',', skiprows=1, ndmin=2)
 
-# Get list of isos 
-network_isos = isos_from_net(net_name)
+def csv_columns(csv_file):
+    "Return the column names of a CSV file, from its first line."
+    with open(csv_file) as f:
+        return [name.strip() for name in f.readline().split(',')]
 
-# Get isotope columns from CSV 
-csv_isos = [col for col in df.columns if col != 'xq']
+def print_warning(message):
+    "Print a warning about the input, the way the builders report them."
+    print(f"  Warning: {message}")
 
-# Create the structured array data type with all network isotopes
-dt = np.dtype([(iso, float) for iso in network_isos])
+def map_csv_columns(columns, network_isos, net_name, warn=print_warning):
+    """Work out where each isotope column of a CSV file goes in a net.
 
-# Create comps list
-comps = []
-sample_xqs = df['xq'].values
+    Parameters
+    ----------
+    columns : list of str
+        The column names of the CSV file, including xq.
+    network_isos : list of str
+        The isotopes in the net.
+    net_name : str
+        The name of the net, used in warnings. Each isotope column that is
+        not in the net gets one warning.
+    warn : callable, optional
+        Called with the text of each warning. The default prints it.
 
-
-for idx, row in df.iterrows():
-    this_comp = np.zeros(1, dtype=dt)
-    
-    # Fill in isotopes from CSV
-    for iso in csv_isos:
-        if iso in network_isos:
-            this_comp[iso] = row[iso]
+    Returns
+    -------
+    csv_cols : np.ndarray of int
+        The CSV columns of the isotopes that are in the net.
+    net_cols : np.ndarray of int
+        The index in `network_isos` of each of those isotopes.
+    """
+    net_index = {iso: j for j, iso in enumerate(network_isos)}
+    csv_cols = []
+    net_cols = []
+    for k, iso in enumerate(columns):
+        if iso == 'xq':
+            continue
+        if iso in net_index:
+            csv_cols.append(k)
+            net_cols.append(net_index[iso])
         else:
-            print(f"  Warning: Isotope {iso} from CSV not in network {net_name}")
-    
-    # Normalize so total mass fraction = 1.0
-    total = sum(this_comp[iso] for iso in csv_isos if iso in network_isos)
-    if total > 0:
-        for iso in network_isos:
-            this_comp[iso] = this_comp[iso] / total    
-    comps.append(this_comp)
+            warn(f"Isotope {iso} from CSV not in network {net_name}")
+    return np.array(csv_cols, dtype=int), np.array(net_cols, dtype=int)
+
+def normalize_layers(table, csv_cols, net_cols, num_isos):
+    """Put the rows of a CSV table in net order and normalize them.
+
+    Parameters
+    ----------
+    table : np.ndarray
+        Rows of a CSV file.
+    csv_cols, net_cols : np.ndarray of int
+        The column mapping from `map_csv_columns`.
+    num_isos : int
+        The number of isotopes in the net.
+
+    Returns
+    -------
+    np.ndarray
+        The mass fractions of each row, with shape (len(table), num_isos).
+        Rows with a positive total are scaled to a total of 1; isotopes of
+        the net that are not in the table are 0.
+    """
+    comps = np.zeros((len(table), num_isos))
+    comps[:, net_cols] = table[:, csv_cols]
+    # add up the columns in CSV order, so every row's total is rounded the
+    # same way whatever the number of columns
+    total = np.zeros(len(table))
+    for k in csv_cols:
+        total += table[:, k]
+    positive = total > 0
+    comps[positive] /= total[positive, None]
+    return comps
+
+def manual_blend(columns, table, network_isos, net_name, multiplier=1e-6, points=2, shape='linear',
+                 warn=print_warning):
+    """Blend the layer compositions listed in a table.
+
+    Parameters
+    ----------
+    columns : list of str
+        The names of the columns of `table`: xq and isotopes.
+    table : np.ndarray
+        One row per layer, with an xq column and a column of mass fractions
+        for each isotope. Each row's xq is the outer boundary of the next
+        layer in.
+    network_isos : list of str
+        The isotopes in the net. Isotopes from `table` that are not in the
+        net are ignored, and each layer is normalized to a total mass
+        fraction of 1.
+    net_name : str
+        The name of the net, used in warnings.
+    multiplier, points, shape : optional
+        Control the transitions between layers; passed on to `blend_comps`.
+    warn : callable, optional
+        Called with the text of each warning (see `map_csv_columns`). The
+        default prints it.
+
+    Returns
+    -------
+    np.array
+        A structured array of blended compositions, as returned by
+        `blend_comps`.
+    """
+    csv_cols, net_cols = map_csv_columns(columns, network_isos, net_name, warn)
+    comps = normalize_layers(table, csv_cols, net_cols, len(network_isos))
+    xq0 = table[:-1, columns.index('xq')]
+    xq, matrix = blend_matrix(comps, xq0, None, multiplier, points, shape)
+    dt = np.dtype([('xq', float)] + [(iso, float) for iso in network_isos])
+    return unstructured_to_structured(np.column_stack([xq, matrix]), dt)
+
+def _data_lines(lines):
+    "Skip the blank and comment lines that `np.loadtxt` would skip."
+    return (line for line in lines if line.split('#', 1)[0].strip())
+
+def csv_layers(csv_file, network_isos, net_name, chunk_rows=1 << 16):
+    """Read the layers of a CSV file in chunks.
+
+    Only `chunk_rows` rows are parsed and held in memory at a time, so files
+    with any number of layers can be blended with `blend_stream`.
+
+    Parameters
+    ----------
+    csv_file : str
+        The name of the CSV file. The first line holds the column names,
+        which must include xq.
+    network_isos : list of str
+        The isotopes in the net.
+    net_name : str
+        The name of the net, used in warnings.
+    chunk_rows : int, optional
+        The number of rows per chunk. The default is 65536.
+
+    Yields
+    ------
+    (np.ndarray, np.ndarray)
+        The xq of each layer and its normalized mass fractions in net order
+        (see `normalize_layers`).
+
+    Raises
+    ------
+    ValueError
+        If there is no xq column.
+    """
+    with open(csv_file) as f:
+        columns = [name.strip() for name in f.readline().split(',')]
+        if 'xq' not in columns:
+            raise ValueError("CSV must have an 'xq' column")
+        xq_col = columns.index('xq')
+        csv_cols, net_cols = map_csv_columns(columns, network_isos, net_name)
+        lines = _data_lines(f)
+        while True:
+            with stage('read csv'):
+                chunk = list(islice(lines, chunk_rows))
+                if not chunk:
+                    break
+                table = np.loadtxt(chunk, delimiter=',', ndmin=2)
+                layers = table[:, xq_col], normalize_layers(table, csv_cols, net_cols, len(network_isos))
+            yield layers
+
+def count_csv_layers(csv_file):
+    "Return the number of layers in a CSV file, without parsing them."
+    with open(csv_file) as f:
+        f.readline()
+        return sum(1 for _ in _data_lines(f))
+
+def write_manual_composition(csv_file, network_isos, net_name, filename,
+                             multiplier=1e-6, points=2, shape='linear', chunk_rows=1 << 16):
+    """Blend the layers of a CSV file and write them, one chunk at a time.
+
+    Writes the same file as `manual_blend` followed by
+    `make_composition_file`, without holding the whole table or the blended
+    profile in memory.
 
+    Parameters
+    ----------
+    csv_file : str
+        The name of the CSV file (see `csv_layers`).
+    network_isos : list of str
+        The isotopes in the net.
+    net_name : str
+        The name of the net, used in warnings.
+    filename : str
+        The name of the composition file to write.
+    multiplier, points, shape : optional
+        Control the transitions between layers; see `blend_comps`.
+    chunk_rows : int, optional
+        The number of CSV rows read at a time. The default is 65536.
 
-boundary_xqs = []
-for i in range(len(sample_xqs)-1):
-    boundary_xqs.append(sample_xqs[i])
+    Returns
+    -------
+    None
 
-configs = []
+    Raises
+    ------
+    ValueError
+        If there is no xq column or there are no layers. Nothing is written
+        in either case.
+    """
+    if 'xq' not in csv_columns(csv_file):
+        raise ValueError("CSV must have an 'xq' column")
+    layers = count_csv_layers(csv_file)
+    if not layers:
+        raise ValueError(f"{csv_file} has no layers")
+    rows = points * (layers - 1) + 2
+    chunks = blend_stream(csv_layers(csv_file, network_isos, net_name, chunk_rows), multiplier, points, shape)
+    write_composition_chunks(rows, len(network_isos), chunks, filename)
 
-for i in range(len(boundary_xqs)):
-    configs.append((boundary_xqs[i], 0, comps[i+1]))
+def main(argv):
+    if len(argv) != 4:
+        print("Error: Must provide 4 args-- python manual_composition.py <initial_mass> <csv_file> <network.net>")
+        sys.exit(1)
 
+    initial_mass = argv[1]
+    csv_file = argv[2]
+    net_name = argv[3]
 
-blend = blend_comps(comps[0], configs)
+    # Get list of isos
+    network_isos = isos_from_net(net_name)
 
-# Generate output filename
-output_filename = f'$PATHNAME/compositions/M{initial_mass[0]}P{initial_mass[2:]}_manual.data'
-make_composition_file(blend, net_name, output_filename)
+    # Generate output filename
+    name = composition_name(initial_mass)
+    output_filename = f'$PATHNAME/compositions/{name}.data'
 
-# Update MESA inlist files
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder', 'initial_mass', f'{initial_mass}'])
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder', 'relax_composition_filename', f"'{output_filename}'"])
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder', 'save_model_filename', 
-               f"'$PATHNAME/outputs/M{initial_mass[0]}P{initial_mass[2:]}_manual.mod'"])
+    # Read, blend, and write the layers a chunk at a time, unless the cache
+    # has a composition built from the same inputs
+    def build(filename):
+        write_manual_composition(csv_file, network_isos, net_name, filename)
 
+    try:
+        if cached_build(manual_key(csv_file, network_isos), output_filename, build):
+            print("Inputs unchanged; reused the cached composition.")
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    evict()
 
-print(f"\nCreated composition file {output_filename}.")
+    # Update MESA inlist files
+    change_inlist('inlist_wd_builder', {
+        'initial_mass': float(initial_mass),
+        'relax_composition_filename': output_filename,
+        'save_model_filename': f'$PATHNAME/outputs/{name}.mod',
+    })
 
+    print(f"\nCreated composition file {output_filename}.")
 
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,23 +1,13 @@
 import sys
 import numpy as np
-import mesa_reader as mr
-import subprocess
-import matplotlib.pyplot as plt
+from numpy.lib.recfunctions import unstructured_to_structured
+from build_cache import cached_build, evict, modular_key
 from composition_blend import blend_comps, make_composition_file
-
-def texify(iso):
-    "Create a TeX-friendly version of an isotope string."
-    element = ''.join([i for i in iso if not i.isdigit()])
-    mass_number = ''.join([i for i in iso if i.isdigit()])
-    return r"$^{" + str(mass_number) + r"}\mathrm{" + f"{element.title()}" + r"}$"
-
-# Check if the required first argument (initial mass) is provided
-if len(sys.argv) < 3:
-    print("Error: Initial mass (float) and model file name (string) are required")
-    sys.exit(1)
-
-initial_mass = sys.argv[1]
-model = mr.MesaData(sys.argv[2]) 
+from inlist import change_inlist
+from instrument import stage
+from list_isos import isos_from_net, smallest_covering_net
+from profile_reader import read_profile
+from resample import resample_profile
 
 # Function to parse a string of floats in bracket format [1.0,2.0,3.0]
 def parse_float_list(arg_string):
@@ -29,92 +19,295 @@ def parse_float_list(arg_string):
         print(f"Error: Invalid float in argument: {arg_string}")
         sys.exit(1)
 
-# Check if optional arguments are provided
-if len(sys.argv) >= 5:  # All four arguments provided
-    sample_xqs = parse_float_list(sys.argv[3])
-    boundary_xqs = parse_float_list(sys.argv[4])
-else:  # Only initial mass provided- prompt for both lists
-    user_samples = input("Enter sample locations as a list of comma-separated floats within brackets: ")
-    sample_xqs = parse_float_list(user_samples)
-    
-    user_bounds = input("Enter boundary locations as a list of comma-separated floats within brackets: ")
-    boundary_xqs = parse_float_list(user_bounds)
-
-if len(boundary_xqs) != len(sample_xqs) - 1:
-    print(f"Error: boundary_xqs must be exactly 1 element shorter than sample_xqs")
-    sys.exit(1)
-
-
-xqs = np.cumsum(model.dq)
-num_layers = len(sample_xqs)
-
-# Ask user if they want to see a plot of compositions and the lines they have drawn on their given model
-plot_bool = input("Would you like to create a plot of your model's composition and sample locations? (y/n): ").lower().strip()
-if plot_bool == 'y':
-    for iso in ['h1', 'he4', 'c12', 'n14', 'o16', 'ne20']:
-        plt.loglog(xqs, model.data(iso), label=texify(iso))
-    
-    plt.legend(loc='best')
-    plt.xlim(1, 1e-8)
-    plt.ylim(1.5e-4, 1.5)
-    plt.xlabel(r"Exterior Fractional Mass")
-    plt.ylabel(r"Mass Fraction")
-
-    # Show vertical dashed lines at sample locations
-    for xq in sample_xqs:
-        plt.axvline(xq, ls='--', color='k')
-    # Show vertical dotted lines at boundary locations
-    for xq in boundary_xqs:
-        plt.axvline(xq, ls=':', color='lightgray')
-    
-    plt.legend(loc='best')
-    plt.savefig(f'{sys.argv[2]}_plot.pdf', bbox_inches='tight')
-    print(f"Plot saved as {sys.argv[2]}_plot.pdf")
-
-# Extract composition at each sample location
-isos = model.bulk_names[model.bulk_names.index('h1'):]
-
-dt = np.dtype([(iso, float) for iso in isos])
-comps = []
-
-
-# Sort xqs in descending order
-sorted_sample_xqs = sorted(sample_xqs, reverse=True) 
-sorted_boundary_xqs = sorted(boundary_xqs, reverse=True)
-
-for i, xq in enumerate(sorted_sample_xqs):
-    this_comp = np.zeros(1, dtype=dt)
-    idx = np.argmin(np.abs(xqs - xq))
-    for iso in isos:
-        this_comp[iso] = model.data(iso)[idx]
-    comps.append(this_comp)
-
-
-configs = []
-# Sort boundary xqs to be back in ascending order
-for i in range(len(sorted_boundary_xqs)):
-    boundary_idx = len(sorted_boundary_xqs) - 1 - i  
-    configs.append((sorted_boundary_xqs[boundary_idx], 0, comps[i+1]))
-
-
-# Blend the compositions
-blend = blend_comps(comps[0], configs)
-
-# Reverse the order of all columns except xq 
-blend_fixed = np.zeros_like(blend)
-blend_fixed['xq'] = blend['xq']
-for iso in blend.dtype.names[1:]: 
-    blend_fixed[iso] = blend[iso][::-1]
-blend = blend_fixed
-
-# Generate output filename
-output_filename = f'$PATHNAME/compositions/M{initial_mass[0]}P{initial_mass[2:]}_CO_WD.data'
-
-make_composition_file(blend, model.header('net_name'), output_filename)
-
-# Update MESA inlist files
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder', 'initial_mass', f'{initial_mass}'])
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder', 'relax_composition_filename', f"'{output_filename}'"])
-subprocess.run(['shmesa', 'change', 'inlist_wd_builder','save_model_filename', f"'$PATHNAME/outputs/M{initial_mass[0]}P{initial_mass[2:]}_CO_WD.mod'"])
-
-print(f"\nCreated composition file {output_filename}.")
\ No newline at end of file
+def composition_name(initial_mass):
+    "Return the base name of the composition and model files for a mass."
+    initial_mass = str(initial_mass)
+    return f'M{initial_mass[0]}P{initial_mass[2:]}_CO_WD'
+
+def plot_samples(model, sample_xqs, boundary_xqs, filename, isotopes=None, blend=None):
+    """Plot a model's composition with the sample and boundary locations.
+
+    Parameters
+    ----------
+    model : ProfileData
+        The reference model, as returned by `read_profile`.
+    sample_xqs : list of float
+        The sample locations, drawn as dashed lines.
+    boundary_xqs : list of float
+        The boundary locations, drawn as dotted lines.
+    filename : str
+        The name of the file to save the plot to.
+    isotopes : list of str, optional
+        The isotopes to draw. The default is `plotting.DEFAULT_ISOTOPES`.
+    blend : np.array, optional
+        A blended composition, as returned by `modular_blend`, to draw over
+        the model.
+    """
+    from plotting import plot_composition
+
+    xqs = np.cumsum(model.dq)
+    abundances = {name: model.data(name) for name in model.bulk_names}
+    overlay = None
+    if blend is not None:
+        overlay = (blend['xq'], {name: blend[name] for name in blend.dtype.names[1:]})
+    plot_composition(filename, xqs, abundances, isotopes=isotopes, sample_xqs=sample_xqs,
+                     boundary_xqs=boundary_xqs, overlay=overlay)
+
+@stage('load model')
+def reference_profile(model):
+    """Load the isotope profile of a reference model into arrays.
+
+    Parameters
+    ----------
+    model : ProfileData
+        The reference model, as returned by `read_profile`. Its isotope
+        columns must start at h1.
+
+    Returns
+    -------
+    xqs : np.ndarray
+        The cumulative `dq` of each zone, which increases from the surface to
+        the center.
+    isos : list of str
+        The isotope names, in the order of the columns of `block`.
+    block : np.ndarray
+        A C-contiguous array of shape (zones, isotopes) with the mass
+        fraction of every isotope in every zone.
+    """
+    xqs = np.cumsum(model.dq)
+    isos = list(model.bulk_names[model.bulk_names.index('h1'):])
+    block = np.column_stack([model.data(iso) for iso in isos])
+    return xqs, isos, block
+
+def smallest_profile_net(reference):
+    """Return the smallest net that holds every isotope with mass in a profile.
+
+    Parameters
+    ----------
+    reference : tuple
+        The profile, as returned by `reference_profile` or
+        `ensemble_reference`. Isotopes that are zero in every zone are
+        ignored.
+
+    Returns
+    -------
+    str or None
+        The name of the net (see `smallest_covering_net`), or `None` if no
+        net holds them all.
+    """
+    _, isos, block = reference
+    return smallest_covering_net([iso for iso, has_mass in zip(isos, block.any(axis=0)) if has_mass])
+
+def auto_net(reference, default=None):
+    """Return the net that 'auto' stands for with a reference profile.
+
+    Parameters
+    ----------
+    reference : tuple
+        The profile; see `smallest_profile_net`.
+    default : str, optional
+        The net to use if no net holds every isotope with mass in the
+        profile, usually the reference model's own net.
+
+    Returns
+    -------
+    net : str
+        The smallest net that holds every isotope with mass, or `default`.
+    covers : bool
+        Whether `net` holds them all, so no mass will be moved between
+        isotopes.
+
+    Raises
+    ------
+    ValueError
+        If no net holds them all and there is no `default`.
+    """
+    net = smallest_profile_net(reference)
+    if net is not None:
+        return net, True
+    if default is None:
+        raise ValueError("No net holds every isotope of the reference profile")
+    return default, False
+
+def nearest_zones(xqs, sample_xqs):
+    """Return the index of the zone closest to each sample location.
+
+    Equivalent to `np.argmin(np.abs(xqs - xq))` for each sample, including
+    picking the outer zone on ties, but resolved with one binary search.
+
+    Parameters
+    ----------
+    xqs : np.ndarray
+        The monotonically increasing coordinate of each zone.
+    sample_xqs : list of float
+        The sample locations.
+
+    Returns
+    -------
+    np.ndarray of int
+    """
+    sample_xqs = np.asarray(sample_xqs, dtype=float)
+    if len(xqs) == 1:
+        return np.zeros(len(sample_xqs), dtype=int)
+    right = np.clip(np.searchsorted(xqs, sample_xqs), 1, len(xqs) - 1)
+    left = right - 1
+    use_left = np.abs(xqs[left] - sample_xqs) <= np.abs(xqs[right] - sample_xqs)
+    # zones with equal coordinates resolve to the outermost one
+    left = np.searchsorted(xqs, xqs[left])
+    return np.where(use_left, left, right)
+
+def modular_blend(reference, sample_xqs, boundary_xqs, multiplier=1e-6, points=2, shape='linear'):
+    """Blend the compositions of a reference model at sample locations.
+
+    Parameters
+    ----------
+    reference : tuple
+        The reference model's profile, as returned by `reference_profile`.
+        Loading it once lets many sample sets share it.
+    sample_xqs : list of float
+        The locations to take each layer's composition from.
+    boundary_xqs : list of float
+        The locations of the boundaries between the layers. Must be exactly
+        one element shorter than `sample_xqs`.
+    multiplier, points, shape : optional
+        Control the transitions between layers; passed on to `blend_comps`.
+
+    Returns
+    -------
+    np.array
+        A structured array of blended compositions, as returned by
+        `blend_comps`.
+    """
+    xqs, isos, block = reference
+    dt = np.dtype([(iso, float) for iso in isos])
+
+    # Sort xqs in descending order
+    sorted_sample_xqs = sorted(sample_xqs, reverse=True)
+    sorted_boundary_xqs = sorted(boundary_xqs, reverse=True)
+
+    # Extract composition at each sample location; each row of the gathered
+    # block becomes a one-element structured array
+    samples = np.ascontiguousarray(block[nearest_zones(xqs, sorted_sample_xqs)])
+    comps = list(samples.view(dt))
+
+    configs = []
+    # Sort boundary xqs to be back in ascending order
+    for i in range(len(sorted_boundary_xqs)):
+        boundary_idx = len(sorted_boundary_xqs) - 1 - i
+        configs.append((sorted_boundary_xqs[boundary_idx], 0, comps[i+1]))
+
+    # Blend the compositions
+    blend = blend_comps(comps[0], configs, multiplier, points, shape)
+
+    # Reverse the order of all columns except xq
+    blend_fixed = np.zeros_like(blend)
+    blend_fixed['xq'] = blend['xq']
+    for iso in blend.dtype.names[1:]:
+        blend_fixed[iso] = blend[iso][::-1]
+    return blend_fixed
+
+@stage('resample')
+def resampled_composition(reference, tolerance):
+    """Reproduce the full composition profile of a reference model.
+
+    Instead of sampling a few layers, keep a small subset of the zones of the
+    reference model that rebuilds every zone's composition within
+    `tolerance` by linear interpolation in log xq (see `resample_profile`).
+
+    Parameters
+    ----------
+    reference : tuple
+        The reference model's profile, as returned by `reference_profile`.
+    tolerance : float
+        The largest allowed absolute error in any mass fraction.
+
+    Returns
+    -------
+    np.array
+        A structured array of compositions with the same layout as the one
+        returned by `blend_comps`.
+    """
+    xqs, isos, block = reference
+    xq, rows = resample_profile(xqs, block, tolerance)
+    data = np.empty((len(xq), len(isos) + 1))
+    data[:, 0] = xq
+    data[:, 1:] = rows
+    return unstructured_to_structured(data, np.dtype([('xq', float)] + [(iso, float) for iso in isos]))
+
+def main(argv):
+    # Reproduce the whole reference profile instead of sampling layers if
+    # asked to with --resample <tolerance>
+    tolerance = None
+    if '--resample' in argv:
+        k = argv.index('--resample')
+        try:
+            tolerance = float(argv[k + 1])
+        except (IndexError, ValueError):
+            print("Error: --resample requires an abundance tolerance (float)")
+            sys.exit(1)
+        argv = argv[:k] + argv[k + 2:]
+
+    # Check if the required first argument (initial mass) is provided
+    if len(argv) < 3:
+        print("Error: Initial mass (float) and model file name (string) are required")
+        sys.exit(1)
+
+    initial_mass = argv[1]
+    model = read_profile(argv[2])
+    reference = reference_profile(model)
+
+    # Check if optional arguments are provided (a resampled build has no
+    # layers to sample)
+    sample_xqs = boundary_xqs = None
+    if tolerance is None and len(argv) >= 5:  # All four arguments provided
+        sample_xqs = parse_float_list(argv[3])
+        boundary_xqs = parse_float_list(argv[4])
+    elif tolerance is None:  # Only initial mass provided- prompt for both lists
+        user_samples = input("Enter sample locations as a list of comma-separated floats within brackets: ")
+        sample_xqs = parse_float_list(user_samples)
+
+        user_bounds = input("Enter boundary locations as a list of comma-separated floats within brackets: ")
+        boundary_xqs = parse_float_list(user_bounds)
+
+    if tolerance is None:
+        if len(boundary_xqs) != len(sample_xqs) - 1:
+            print(f"Error: boundary_xqs must be exactly 1 element shorter than sample_xqs")
+            sys.exit(1)
+
+        # Ask user if they want to see a plot of compositions and the lines they have drawn on their given model
+        plot_bool = input("Would you like to create a plot of your model's composition and sample locations? (y/n): ").lower().strip()
+        if plot_bool == 'y':
+            plot_samples(model, sample_xqs, boundary_xqs, f'{argv[2]}_plot.pdf')
+            print(f"Plot saved as {argv[2]}_plot.pdf")
+
+    # Generate output filename
+    name = composition_name(initial_mass)
+    output_filename = f'$PATHNAME/compositions/{name}.data'
+
+    # Only blend if the cache has no composition built from the same inputs
+    net = model.header('net_name')
+    key = modular_key(argv[2], isos_from_net(net), sample_xqs, boundary_xqs, tolerance)
+
+    def build(filename):
+        if tolerance is not None:
+            blend = resampled_composition(reference, tolerance)
+            print(f"Kept {len(blend)} of {len(reference[0])} zones of {argv[2]} (tolerance {tolerance:g}).")
+        else:
+            blend = modular_blend(reference, sample_xqs, boundary_xqs)
+        make_composition_file(blend, net, filename)
+
+    if cached_build(key, output_filename, build):
+        print("Inputs unchanged; reused the cached composition.")
+    evict()
+
+    # Update MESA inlist files
+    change_inlist('inlist_wd_builder', {
+        'initial_mass': float(initial_mass),
+        'relax_composition_filename': output_filename,
+        'save_model_filename': f'$PATHNAME/outputs/{name}.mod',
+    })
+
+    print(f"\nCreated composition file {output_filename}.")
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,218 @@
+"""Plot compositions without pyplot, so plots can be made in parallel.
+
+Figures are drawn with Matplotlib's object API on the non-interactive Agg
+canvas. Every curve is decimated in log xq to about the resolution it is
+drawn at before plotting, so plots of profiles with millions of zones stay
+fast and small. `plot_batch` renders many plots in a process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+
+from instrument import stage
+
+DEFAULT_ISOTOPES = ('h1', 'he4', 'c12', 'n14', 'o16', 'ne20')
+# about twice the width of the plot in pixels at 300 dpi
+DECIMATION_BINS = 4000
+
+def texify(iso):
+    "Create a TeX-friendly version of an isotope string."
+    element = ''.join([i for i in iso if not i.isdigit()])
+    mass_number = ''.join([i for i in iso if i.isdigit()])
+    return r"$^{" + str(mass_number) + r"}\mathrm{" + f"{element.title()}" + r"}$"
+
+def decimate(x, curves, bins=DECIMATION_BINS):
+    """Pick the points needed to draw curves at a given resolution.
+
+    The positive part of `x` is split into `bins` bins evenly spaced in log
+    x. In each bin, the first and last points are kept, and so are the
+    points where any curve reaches its minimum and maximum in the bin. A
+    line through the kept points covers the same pixels as one through
+    every point.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The x coordinate of each point, in increasing order.
+    curves : np.ndarray
+        The y values, with shape (len(x),) or (len(x), number of curves).
+    bins : int, optional
+        The number of bins. The default is `DECIMATION_BINS`.
+
+    Returns
+    -------
+    np.ndarray of int
+        The indices of the points to keep, in increasing order. Points with
+        x <= 0, which cannot be drawn on a log axis, are dropped.
+    """
+    x = np.asarray(x, dtype=float)
+    points = np.flatnonzero(x > 0)
+    if len(points) <= 4 * bins:
+        return points
+    values = np.asarray(curves, dtype=float).reshape(len(x), -1)[points]
+    log_x = np.log10(x[points])
+    span = log_x[-1] - log_x[0]
+    if span > 0:
+        bin_of = np.minimum((log_x - log_x[0]) / span * bins, bins - 1).astype(int)
+    else:
+        bin_of = np.zeros(len(points), dtype=int)
+    starts = np.flatnonzero(np.r_[True, bin_of[1:] != bin_of[:-1]])
+    stops = np.r_[starts[1:], len(points)]
+    counts = stops - starts
+    # the first point of each bin where a curve reaches its extreme, found
+    # for every bin and curve at once; other points get an index past the end
+    position = np.arange(len(points))[:, None]
+    keep = [starts, stops - 1]
+    with np.errstate(invalid='ignore'):
+        for reduce in (np.minimum, np.maximum):
+            extreme = np.repeat(reduce.reduceat(values, starts, axis=0), counts, axis=0)
+            first = np.minimum.reduceat(np.where(values == extreme, position, len(points)), starts, axis=0)
+            keep.append(first[first < len(points)])
+    return points[np.unique(np.concatenate(keep))]
+
+def composition_figure(xq, abundances, isotopes=None, sample_xqs=(), boundary_xqs=(), overlay=None,
+                       bins=DECIMATION_BINS, title=None):
+    """Draw mass fractions against exterior fractional mass.
+
+    Parameters
+    ----------
+    xq : np.ndarray
+        The fractional external mass coordinate of each zone.
+    abundances : mapping of str to np.ndarray
+        The mass fractions of each isotope, one per zone.
+    isotopes : list of str, optional
+        The isotopes to draw. The default is the ones in `DEFAULT_ISOTOPES`
+        that are in `abundances`.
+    sample_xqs : list of float, optional
+        Sample locations, drawn as dashed lines.
+    boundary_xqs : list of float, optional
+        Boundary locations, drawn as dotted lines.
+    overlay : tuple of (np.ndarray, mapping of str to np.ndarray), optional
+        Another composition, such as the blended output, drawn over the
+        first with dashed lines of the same colors. Isotopes it does not
+        have are skipped.
+    bins : int, optional
+        The resolution of the decimation (see `decimate`).
+    title : str, optional
+        A title for the plot.
+
+    Returns
+    -------
+    matplotlib.figure.Figure
+        The figure, attached to an Agg canvas.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    if isotopes is None:
+        isotopes = [iso for iso in DEFAULT_ISOTOPES if iso in abundances]
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    keep = decimate(xq, np.column_stack([abundances[iso] for iso in isotopes]), bins) if isotopes else []
+    colors = {}
+    for iso in isotopes:
+        line, = ax.plot(np.asarray(xq)[keep], np.asarray(abundances[iso])[keep], label=texify(iso))
+        colors[iso] = line.get_color()
+    if overlay is not None:
+        overlay_xq, overlay_abundances = overlay
+        drawn = [iso for iso in isotopes if iso in overlay_abundances]
+        if drawn:
+            keep = decimate(overlay_xq, np.column_stack([overlay_abundances[iso] for iso in drawn]), bins)
+            for iso in drawn:
+                ax.plot(np.asarray(overlay_xq)[keep], np.asarray(overlay_abundances[iso])[keep],
+                        ls='--', lw=1, color=colors[iso])
+
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlim(1, 1e-8)
+    ax.set_ylim(1.5e-4, 1.5)
+    ax.set_xlabel(r"Exterior Fractional Mass")
+    ax.set_ylabel(r"Mass Fraction")
+    if title:
+        ax.set_title(title)
+
+    # Show vertical dashed lines at sample locations
+    for sample_xq in sample_xqs:
+        ax.axvline(sample_xq, ls='--', color='k')
+    # Show vertical dotted lines at boundary locations
+    for boundary_xq in boundary_xqs:
+        ax.axvline(boundary_xq, ls=':', color='lightgray')
+
+    ax.legend(loc='best')
+    return fig
+
+@stage('plot')
+def plot_composition(filename, xq, abundances, **kwargs):
+    """Draw a composition with `composition_figure` and save it to a file.
+
+    Returns
+    -------
+    str
+        `filename`.
+    """
+    composition_figure(xq, abundances, **kwargs).savefig(filename, bbox_inches='tight')
+    return filename
+
+def plot_files(filename, model=None, composition=None, net=None, **kwargs):
+    """Plot a reference model and a composition file, read from disk.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the plot to save.
+    model : str, optional
+        A MESA profile to draw (see `read_profile`).
+    composition : str, optional
+        A composition file (see `read_composition`), drawn over `model` if
+        both are given.
+    net : str, optional
+        The net `composition` was written for, to name its columns. Required
+        if `composition` is given.
+    **kwargs
+        Passed on to `composition_figure`.
+
+    Returns
+    -------
+    str
+        `filename`.
+    """
+    layers = []
+    if model is not None:
+        from profile_reader import read_profile
+        profile = read_profile(model)
+        layers.append((np.cumsum(profile.dq), {name: profile.data(name) for name in profile.bulk_names}))
+    if composition is not None:
+        from composition_file import read_composition
+        comp_xq, matrix, isotopes = read_composition(composition, net)
+        layers.append((comp_xq, dict(zip(isotopes, matrix.T))))
+    if not layers:
+        raise ValueError("Nothing to plot; give a model or a composition file")
+    return plot_composition(filename, *layers[0], overlay=layers[1] if len(layers) > 1 else None, **kwargs)
+
+def _plot_files(job):
+    return plot_files(**job)
+
+def plot_batch(jobs, processes=None):
+    """Render many plots in parallel.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        The keyword arguments of `plot_files` for each plot. Files are read
+        by the worker processes, so only their names are sent to them.
+    processes : int, optional
+        The number of worker processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    list of str
+        The names of the plots, in the order of `jobs`.
+    """
+    processes = min(processes or cpu_count(), max(len(jobs), 1))
+    if processes == 1:
+        return [_plot_files(job) for job in jobs]
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(_plot_files, jobs))
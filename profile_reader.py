@@ -0,0 +1,159 @@
+"""Read only the columns the builders need from MESA profiles.
+
+`read_profile` parses the header and the requested columns of a profile
+(by default `dq` and the isotope columns, which start at h1) and saves them
+as a binary snapshot next to the profile. Later reads of the same, unchanged
+profile memory-map the snapshot instead of parsing the text again.
+"""
+import json
+import shlex
+from os import fdopen, replace, stat
+from os.path import abspath, dirname
+from tempfile import mkstemp
+
+import numpy as np
+
+from instrument import stage
+
+# a profile has three lines of header (column numbers, names, and values), a
+# blank line, and then column numbers and names before the data
+HEADER_LINES = 6
+
+def _parse_header_value(text):
+    "Convert a header value to a number if possible."
+    for kind in (int, float):
+        try:
+            return kind(text.replace('D', 'E').replace('d', 'e'))
+        except ValueError:
+            pass
+    return text
+
+class ProfileData:
+    """Columns and header values of a MESA profile.
+
+    Provides the parts of the `mesa_reader.MesaData` interface the builders
+    use: `dq`, `bulk_names`, `data`, and `header`.
+    """
+
+    def __init__(self, columns, data, header_data):
+        self.bulk_names = tuple(columns)
+        self.header_data = header_data
+        self._data = data
+        self._index = {name: k for k, name in enumerate(columns)}
+
+    @property
+    def dq(self):
+        return self.data('dq')
+
+    def data(self, name):
+        "Return a column, without copying it."
+        return self._data[:, self._index[name]]
+
+    def header(self, name):
+        "Return a header value."
+        return self.header_data[name]
+
+def snapshot_names(filename):
+    "Return the names of the data and metadata files of a profile's snapshot."
+    return f"{filename}.columns.npy", f"{filename}.columns.json"
+
+def _read_header(filename):
+    with open(filename) as f:
+        lines = [f.readline() for _ in range(HEADER_LINES)]
+    header_names = lines[1].split()
+    try:
+        values = shlex.split(lines[2])
+    except ValueError:
+        values = lines[2].split()
+    header_values = [_parse_header_value(value) for value in values]
+    return dict(zip(header_names, header_values)), lines[5].split()
+
+def _default_columns(names):
+    "dq and every column from h1 on, like `reference_profile` uses."
+    return ['dq'] + names[names.index('h1'):]
+
+def _load_snapshot(filename, columns, info):
+    data_name, meta_name = snapshot_names(filename)
+    try:
+        with open(meta_name) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('mtime_ns') != info.st_mtime_ns or meta.get('size') != info.st_size:
+        return None
+    if columns is None:
+        columns = _default_columns(meta['names'])
+    if not set(columns) <= set(meta['columns']):
+        return None
+    try:
+        data = np.load(data_name, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if list(data.shape) != meta['shape']:
+        # the data was replaced by another process after we read the metadata
+        return None
+    profile = ProfileData(meta['columns'], data, meta['header'])
+    if list(columns) != meta['columns']:
+        # a subset of the snapshot's columns
+        profile = ProfileData(columns, np.column_stack([profile.data(name) for name in columns]), meta['header'])
+    return profile
+
+def _save_snapshot(filename, profile, names, info):
+    data_name, meta_name = snapshot_names(filename)
+    directory = dirname(abspath(filename))
+    try:
+        # write both files under temporary names and rename them, data first,
+        # so a snapshot is only used once it is complete
+        fd, tmp_name = mkstemp(dir=directory, suffix='.npy.tmp')
+        with fdopen(fd, 'wb') as f:
+            # column-major, so every column of the memory map is contiguous
+            np.save(f, np.asfortranarray(profile._data))
+        replace(tmp_name, data_name)
+        fd, tmp_name = mkstemp(dir=directory, suffix='.json.tmp')
+        with fdopen(fd, 'w') as f:
+            json.dump({'mtime_ns': info.st_mtime_ns, 'size': info.st_size, 'names': names,
+                       'shape': list(profile._data.shape), 'columns': list(profile.bulk_names),
+                       'header': profile.header_data}, f)
+        replace(tmp_name, meta_name)
+    except OSError:
+        # the snapshot is only an optimization
+        pass
+
+@stage('read profile')
+def read_profile(filename, columns=None, snapshot=True):
+    """Read some columns of a MESA profile.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the profile.
+    columns : list of str, optional
+        The columns to read. The default is `dq` and every column from `h1`
+        on, which are the isotope mass fractions.
+    snapshot : bool, optional
+        If `True` (the default), use the binary snapshot next to the profile
+        when it matches the profile's modification time and size, and
+        otherwise write one after parsing the profile.
+
+    Returns
+    -------
+    ProfileData
+        The columns and the header values.
+    """
+    info = stat(filename)
+    if snapshot:
+        profile = _load_snapshot(filename, columns, info)
+        if profile is not None:
+            return profile
+    header_data, names = _read_header(filename)
+    if columns is None:
+        columns = _default_columns(names)
+    missing = [name for name in columns if name not in names]
+    if missing:
+        raise KeyError(f"Not columns of {filename}: {', '.join(missing)}")
+    # parse only the requested columns, in a single pass over the file
+    data = np.loadtxt(filename, skiprows=HEADER_LINES, usecols=[names.index(name) for name in columns], ndmin=2)
+    profile = ProfileData(columns, data, header_data)
+    if snapshot:
+        _save_snapshot(filename, profile, names, info)
+    return profile
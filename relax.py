@@ -0,0 +1,324 @@
+#! /usr/bin/env python3
+"""Build compositions and relax them into white dwarf models with wd_builder.
+
+`sweep.py` only writes composition files. This runs the whole pipeline for
+every point of a sweep (see sweep.py for the grid file): each composition is
+built in a process pool, using the build cache, and as soon as it is ready
+the wd_builder executable relaxes it into a model in a work directory of its
+own. Up to one run per CPU core goes at a time. To run it, use:
+
+    python relax.py grid.json [--executable CMD] [--jobs N] [--threads-per-job T]
+                              [--retries R] [--timeout S] [--workdir runs] [--model-dir outputs]
+                              [--stream] [--results FILE]
+
+Each work directory, `<workdir>/<name>`, gets copies of `inlist` and
+`inlist_pgstar` and its own `inlist_wd_builder`. That file sets the
+composition file, initial mass, net, and model file of the run, and turns
+off pgstar and the pause before terminating, so runs need no display or
+keyboard. The output of every attempt is saved in `run.log` there.
+A run succeeds if it exits with status 0 and writes its model to
+`<model-dir>/<name>.mod`; otherwise it is retried.
+
+The executable defaults to `star` in the current directory (run `./mk` in
+wd_builder first). Any command can stand in for it, such as a script that
+reads `inlist_wd_builder` and writes a fake model, to test a pipeline
+without MESA. It is run in the work directory with `OMP_NUM_THREADS` set to
+`--threads-per-job`.
+"""
+import argparse
+import asyncio
+import json
+import shlex
+import shutil
+import sys
+import time
+from os import cpu_count, environ, makedirs, stat
+from os.path import abspath, basename, isfile, join
+
+try:
+    from os import killpg
+    from signal import SIGKILL
+except ImportError:
+    # not available on Windows; see `_kill`
+    pass
+
+from inlist import change_inlist
+from sweep import build_point, build_pool, prepare_sweep
+
+def available_cores():
+    "Return the number of CPUs this process may run on."
+    try:
+        from os import sched_getaffinity
+        return len(sched_getaffinity(0))
+    except (ImportError, OSError):
+        # not available on macOS or Windows
+        return cpu_count() or 1
+
+def relax_changes(composition, model_file, initial_mass, net):
+    """Return the inlist_wd_builder values for relaxing one composition.
+
+    Parameters
+    ----------
+    composition : str
+        The composition file.
+    model_file : str
+        Where the model should be saved.
+    initial_mass : float or str
+        The initial mass.
+    net : str
+        The net the composition was written for, with or without the .net
+        extension.
+
+    Returns
+    -------
+    dict
+        Changes for `change_inlist`, with absolute paths, and pgstar and the
+        pause before terminating turned off.
+    """
+    return {
+        'initial_mass': float(initial_mass),
+        'relax_composition_filename': abspath(composition),
+        'save_model_filename': abspath(model_file),
+        'new_net_name': net if net.endswith('.net') else f'{net}.net',
+        'pgstar_flag': False,
+        'pause_before_terminate': False,
+    }
+
+def prepare_job_dir(job_dir, changes, source_dir='.', template='inlist_wd_builder'):
+    """Set up the work directory of one run.
+
+    Parameters
+    ----------
+    job_dir : str
+        The work directory; created if needed.
+    changes : dict
+        The values to change in the job's copy of `template`; see
+        `relax_changes`.
+    source_dir : str, optional
+        The wd_builder directory, which holds `inlist`, `inlist_pgstar` (if
+        any), and `template`. The default is the current directory.
+    template : str, optional
+        The inlist to copy and change. The copy is always named
+        `inlist_wd_builder`, the name `inlist` refers to.
+
+    Returns
+    -------
+    str
+        The name of the job's inlist_wd_builder.
+    """
+    makedirs(job_dir, exist_ok=True)
+    for name in ('inlist', 'inlist_pgstar'):
+        if isfile(join(source_dir, name)):
+            shutil.copyfile(join(source_dir, name), join(job_dir, name))
+    return change_inlist(join(source_dir, template), changes, output=join(job_dir, 'inlist_wd_builder'))
+
+def _file_state(filename):
+    "Return what identifies a version of a file, or `None` if it does not exist."
+    try:
+        info = stat(filename)
+    except OSError:
+        return None
+    return info.st_ino, info.st_mtime_ns, info.st_size
+
+def _kill(process):
+    "Kill a process and everything it started, like the star binary run by a script."
+    try:
+        killpg(process.pid, SIGKILL)
+    except (NameError, OSError):
+        # no process groups on Windows
+        process.kill()
+
+async def _pump(process, log, prefix=None):
+    "Copy a process's output to a log (and stdout, with `prefix`) until it exits."
+    async for line in process.stdout:
+        text = line.decode(errors='replace')
+        log.write(text)
+        if prefix is not None:
+            print(f"{prefix} {text}", end='' if text.endswith('\n') else '\n')
+    return await process.wait()
+
+async def run_relax(job_dir, command, retries=1, timeout=None, threads=1, output=None, stream_prefix=None):
+    """Run a command in a work directory, retrying it if it fails.
+
+    Parameters
+    ----------
+    job_dir : str
+        The work directory, set up with `prepare_job_dir`.
+    command : list of str
+        The command to run, like ['/path/to/star'].
+    retries : int, optional
+        How many times to run the command again after a failure. The default
+        is 1.
+    timeout : float, optional
+        Kill an attempt after this many seconds. The default is no limit.
+    threads : int, optional
+        The value of `OMP_NUM_THREADS` for the command. The default is 1.
+    output : str, optional
+        A file the command must write for an attempt to count as a success.
+        A file left over from an earlier run does not count.
+    stream_prefix : str, optional
+        If given, echo the command's output to stdout, each line after this
+        prefix.
+
+    Returns
+    -------
+    dict
+        'returncode' of the last attempt (`None` if it timed out or could
+        not start), 'ok', the number of 'attempts', the 'seconds' they took
+        in all, and the name of the 'log' file.
+    """
+    log_file = join(job_dir, 'run.log')
+    env = {**environ, 'OMP_NUM_THREADS': str(threads)}
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        for attempt in range(1, retries + 2):
+            log.write(f"=== attempt {attempt}: {shlex.join(command)}\n")
+            log.flush()
+            before = None if output is None else _file_state(output)
+            try:
+                # in a session of its own, so a timeout can kill all of it
+                process = await asyncio.create_subprocess_exec(
+                    *command, cwd=job_dir, env=env, stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=True)
+            except OSError as e:
+                # a missing or non-executable command fails the same way every time
+                log.write(f"=== could not start: {e}\n")
+                return {'returncode': None, 'ok': False, 'attempts': attempt,
+                        'seconds': time.perf_counter() - start, 'log': log_file}
+            try:
+                returncode = await asyncio.wait_for(_pump(process, log, stream_prefix), timeout)
+            except asyncio.TimeoutError:
+                _kill(process)
+                await process.wait()
+                returncode = None
+                log.write(f"=== timed out after {timeout:g} s\n")
+            ok = returncode == 0 and (output is None or _file_state(output) not in (None, before))
+            if returncode == 0 and not ok:
+                log.write(f"=== exited with status 0 but did not write {output}\n")
+            else:
+                log.write(f"=== exited with status {returncode}\n")
+            if ok:
+                break
+    return {'returncode': returncode, 'ok': ok, 'attempts': attempt,
+            'seconds': time.perf_counter() - start, 'log': log_file}
+
+async def run_pipeline(spec, command, workdir='runs', model_dir='outputs', jobs=None, threads_per_job=1,
+                       retries=1, timeout=None, stream=False, processes=None, source_dir='.',
+                       template='inlist_wd_builder'):
+    """Build every composition of a sweep and relax each into a model.
+
+    Builds run in a process pool; each composition's run starts as soon as
+    it is built and a slot is free, so building and relaxing overlap.
+
+    Parameters
+    ----------
+    spec : dict
+        The sweep specification; see sweep.py.
+    command : list of str
+        The wd_builder executable and its arguments.
+    workdir : str, optional
+        Where to make each run's work directory. The default is 'runs'.
+    model_dir : str, optional
+        Where to save the models. The default is 'outputs'.
+    jobs : int, optional
+        The most runs at a time. The default is the number of available
+        cores divided by `threads_per_job`.
+    threads_per_job : int, optional
+        The OpenMP threads of each run. The default is 1.
+    retries, timeout : optional
+        See `run_relax`.
+    stream : bool, optional
+        Echo every run's output to stdout, after the job's name.
+    processes : int, optional
+        The number of build processes. The default is the number of CPUs.
+    source_dir, template : str, optional
+        See `prepare_job_dir`.
+
+    Returns
+    -------
+    list of dict
+        For each grid point, in grid order: the job's 'name', its
+        'composition', 'model', and 'workdir', and either the result of
+        `run_relax` or, if the build failed, 'ok' False and the 'error'.
+    """
+    if spec.get('format', 'data') != 'data':
+        raise ValueError("wd_builder reads text compositions only; remove \"format\" from the sweep")
+    prepared = prepare_sweep(spec)
+    slots = asyncio.Semaphore(jobs or max(1, available_cores() // threads_per_job))
+    loop = asyncio.get_running_loop()
+    makedirs(model_dir, exist_ok=True)
+
+    async def job(point, pool):
+        _, net, _, filename, initial_mass, _ = point
+        name = basename(filename).removesuffix('.data')
+        model_file = abspath(join(model_dir, f'{name}.mod'))
+        job_dir = abspath(join(workdir, name))
+        result = {'name': name, 'composition': abspath(filename), 'model': model_file, 'workdir': job_dir}
+        try:
+            await loop.run_in_executor(pool, build_point, point)
+        except Exception as e:
+            print(f"[{name}] build failed: {e}")
+            return {**result, 'ok': False, 'error': str(e)}
+        async with slots:
+            try:
+                prepare_job_dir(job_dir, relax_changes(filename, model_file, initial_mass, net), source_dir, template)
+            except (OSError, KeyError) as e:
+                print(f"[{name}] could not set up {job_dir}: {e}")
+                return {**result, 'ok': False, 'error': str(e)}
+            print(f"[{name}] relaxing in {job_dir}")
+            result.update(await run_relax(job_dir, command, retries, timeout, threads_per_job, model_file,
+                                          f"[{name}]" if stream else None))
+        status = 'done' if result['ok'] else f"failed (status {result['returncode']})"
+        print(f"[{name}] {status} after {result['attempts']} attempt(s), {result['seconds']:.1f} s; "
+              f"log in {result['log']}")
+        return result
+
+    with build_pool(prepared, processes) as pool:
+        results = await asyncio.gather(*(job(point, pool) for point in prepared[3]))
+    if spec.get('cache', True):
+        from build_cache import evict
+        evict()
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build compositions and relax them into models with wd_builder.")
+    parser.add_argument('spec', help="JSON file describing the grid (see sweep.py)")
+    parser.add_argument('--executable', default=None,
+                        help="command that relaxes a model, run in each work directory (default: ./star "
+                             "from the current directory)")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="most runs at a time (default: available cores / threads per job)")
+    parser.add_argument('--threads-per-job', type=int, default=1, help="OMP_NUM_THREADS of each run (default: 1)")
+    parser.add_argument('--retries', type=int, default=1, help="times to retry a failed run (default: 1)")
+    parser.add_argument('--timeout', type=float, default=None, help="kill a run after this many seconds")
+    parser.add_argument('--workdir', default='runs', help="where to make the work directories (default: runs)")
+    parser.add_argument('--model-dir', default='outputs', help="where to save the models (default: outputs)")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of build processes (default: number of CPUs)")
+    parser.add_argument('--stream', action='store_true', help="echo the output of every run")
+    parser.add_argument('--results', metavar='FILE', help="save the result of every job as JSON")
+    args = parser.parse_args(argv[1:])
+
+    command = shlex.split(args.executable) if args.executable else ['star']
+    if '/' in command[0] or command == ['star']:
+        # runs start in their own work directories
+        command[0] = abspath(command[0])
+    with open(args.spec) as f:
+        spec = json.load(f)
+    start = time.perf_counter()
+    results = asyncio.run(run_pipeline(spec, command, args.workdir, args.model_dir, args.jobs,
+                                       args.threads_per_job, args.retries, args.timeout, args.stream,
+                                       args.processes))
+    failed = [result for result in results if not result['ok']]
+    print(f"Relaxed {len(results) - len(failed)} of {len(results)} models in {time.perf_counter() - start:.1f} s.")
+    for result in failed:
+        print(f"  {result['name']}: {result.get('error') or result['log']}")
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,84 @@
+import numpy as np
+
+def simplify_profile(x, values, tolerance):
+    """Find a small set of knots that reproduce a profile within a tolerance.
+
+    Uses the Ramer-Douglas-Peucker algorithm on all columns at once: a
+    segment between two knots is split at the point where linear
+    interpolation is worst until, for every point and every column, linear
+    interpolation between the surrounding knots is within `tolerance` of
+    the original value. The splits are greedy, so the knots are not always
+    the fewest possible. Each split is evaluated for the whole segment in
+    one vectorized step, so a profile of n points costs O(n log n) array
+    operations in typical cases and O(n^2) in the worst case, when every
+    split peels off a single point.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        The monotonically increasing coordinate of each point.
+    values : np.ndarray
+        The profile, with shape (len(x), columns).
+    tolerance : float
+        The largest allowed absolute error in any column.
+
+    Returns
+    -------
+    np.ndarray of int
+        The indices of the knots, in increasing order, always including the
+        first and last points.
+    """
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, n - 1)]
+    while segments:
+        i, j = segments.pop()
+        if j - i < 2:
+            continue
+        span = x[j] - x[i]
+        frac = (x[i + 1:j] - x[i]) / span if span > 0 else np.zeros(j - i - 1)
+        interpolated = values[i] + frac[:, None] * (values[j] - values[i])
+        errors = np.abs(values[i + 1:j] - interpolated).max(axis=1)
+        worst = np.argmax(errors)
+        if errors[worst] > tolerance:
+            k = i + 1 + worst
+            keep[k] = True
+            segments.append((i, k))
+            segments.append((k, j))
+    return np.flatnonzero(keep)
+
+def resample_profile(xqs, block, tolerance):
+    """Reduce a full composition profile to the knots needed to rebuild it.
+
+    The profile is treated as piecewise linear in the log of the fractional
+    external mass coordinate, and every zone is reproduced within
+    `tolerance` in every isotope.
+
+    Parameters
+    ----------
+    xqs : np.ndarray
+        The fractional external mass coordinate at the bottom of each zone,
+        increasing from the surface to the center (the cumulative `dq`).
+    block : np.ndarray
+        The mass fractions, with shape (zones, isotopes).
+    tolerance : float
+        The largest allowed absolute error in any mass fraction.
+
+    Returns
+    -------
+    xq : np.ndarray
+        The coordinate of each knot, from 0 at the surface to 1 at the
+        center.
+    rows : np.ndarray
+        The mass fractions at each knot, with shape (len(xq), isotopes).
+    """
+    # each zone's composition starts at the top of the zone; the last zone
+    # extends to the center
+    tops = np.concatenate([[0], xqs[:-1]])
+    xq = np.concatenate([tops, [1]])
+    rows = np.concatenate([block, block[-1:]])
+    # the surface point stays linear in xq since log(0) is undefined
+    knots = simplify_profile(np.log10(xq[1:]), rows[1:], tolerance) + 1
+    knots = np.concatenate([[0], knots])
+    return xq[knots], rows[knots]
@@ -0,0 +1,342 @@
+#! /usr/bin/env python3
+"""Build a grid of composition files in parallel.
+
+The grid is described by a JSON file. To sample a reference MESA model (the
+modular method), give the model and one or more sets of sample/boundary
+locations:
+
+    {
+        "model": "LOGS/profile1.data",
+        "initial_masses": [0.6, 0.7, 0.8],
+        "xq_sets": [
+            {"sample_xqs": [1e-6, 1e-3, 0.5], "boundary_xqs": [1e-4, 1e-2]}
+        ],
+        "nets": ["co_burn.net"]
+    }
+
+If "nets" is omitted, the model's own net is used. A net of "auto" is the
+smallest net in $MESA_DIR that holds every isotope of the model (or .csv
+file), so no mass has to be moved between isotopes. To blend the layers of a
+.csv file (the manual method), give "csv" instead of "model" and "xq_sets";
+"nets" is then required. Optional keys are "multiplier" (see `blend_comps`),
+"output_dir" (default "compositions"), "cache" (default true; see
+build_cache.py), which reuses compositions whose inputs have not changed, so
+re-running a sweep after a small change only rebuilds the affected points,
+and "format": "data" (the default) for the text files MESA reads, or "npz"
+or "npy" for smaller binary files that are quicker to write and read back
+(see composition_file.py), for sweeps whose results are analyzed rather
+than relaxed.
+
+One composition is written for every combination of initial mass, xq set,
+and net. To run a sweep, run:
+
+    python sweep.py grid.json [--processes N] [--validate] [--plot] [--timings FILE] [--profile DIR]
+
+With --validate, the files written are checked afterwards (see
+composition_file.py). With --plot, each is plotted (see plotting.py). With
+--timings, the time and memory every stage of every build took is appended
+to a JSON Lines file and summarized (see instrument.py); --profile also
+saves a cProfile and tracemalloc report per build.
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import product
+from os import cpu_count, makedirs
+from os.path import join
+
+from build_cache import cached_build, evict, manual_key, modular_key
+from composition_blend import make_composition_file
+from instrument import build_record
+from list_isos import isos_from_net, resolve_net
+
+# the values of a spec's "format", which are also the extensions of its files
+FORMATS = ('data', 'npz', 'npy')
+
+# state shared by every grid point a worker builds; set once per worker by
+# `_init_worker` so the reference model and nets are not reloaded per point
+_shared = {}
+
+def _init_worker(mode, source, isotopes_by_net, timings=False, profile_dir=None):
+    _shared['mode'] = mode
+    _shared['source'] = source
+    _shared['isotopes_by_net'] = isotopes_by_net
+    _shared['timings'] = timings
+    _shared['profile_dir'] = profile_dir
+
+def build_point(point):
+    """Build and write the composition for one grid point.
+
+    Runs in a worker of `build_pool`. `point` is a grid point followed by
+    its cache key, or `None` to not use the cache. Returns the name of the file written, the time it took in
+    seconds, whether it came from the cache, and the build's record from
+    `build_record` (`None` unless timings were asked for).
+    """
+    xq_set, net, multiplier, filename, _, key = point
+    start = time.perf_counter()
+    isotopes = _shared['isotopes_by_net'][net]
+
+    def build(name):
+        if _shared['mode'] == 'modular':
+            from modular_composition import modular_blend
+            blend = modular_blend(_shared['source'], xq_set['sample_xqs'], xq_set['boundary_xqs'], multiplier)
+        else:
+            from manual_composition import manual_blend
+            blend = manual_blend(*_shared['source'], isotopes, net, multiplier)
+        make_composition_file(blend, net, name, isotopes=isotopes)
+
+    timed = build_record(filename, _shared['profile_dir'], net=net) if _shared['timings'] else nullcontext()
+    with timed as record:
+        if key is None:
+            build(filename)
+            cached = False
+        else:
+            cached = cached_build(key, filename, build)
+        if record is not None:
+            record['cached'] = cached
+    return filename, time.perf_counter() - start, cached, record
+
+def grid_points(spec, default_net=None):
+    """Return the grid points described by a sweep specification.
+
+    Parameters
+    ----------
+    spec : dict
+        The sweep specification; see the module docstring.
+    default_net : str, optional
+        The net to use if `spec` does not list any.
+
+    Returns
+    -------
+    list of tuple
+        One (xq_set, net, multiplier, filename, initial_mass) tuple per grid
+        point. `xq_set` is `None` for manual sweeps.
+    """
+    modular = 'model' in spec
+    nets = spec.get('nets') or [default_net]
+    xq_sets = spec['xq_sets'] if modular else [None]
+    multiplier = spec.get('multiplier', 1e-6)
+    output_dir = spec.get('output_dir', 'compositions')
+    extension = spec.get('format', 'data')
+    if extension not in FORMATS:
+        raise ValueError(f"Unknown format {extension!r}; use one of {FORMATS}")
+    if modular:
+        from modular_composition import composition_name
+    else:
+        from manual_composition import composition_name
+    if modular:
+        for xq_set in xq_sets:
+            if len(xq_set['boundary_xqs']) != len(xq_set['sample_xqs']) - 1:
+                raise ValueError("boundary_xqs must be exactly 1 element shorter than sample_xqs")
+
+    points = []
+    for initial_mass, (k, xq_set), net in product(spec['initial_masses'], enumerate(xq_sets), nets):
+        name = composition_name(initial_mass)
+        if modular:
+            name += f"_{k:03d}"
+        name += f"_{net.replace('.net', '')}.{extension}"
+        points.append((xq_set, net, multiplier, join(output_dir, name), initial_mass))
+    return points
+
+def run_sweep(spec, processes=None, records=None, profile_dir=None):
+    """Build every composition in a sweep specification.
+
+    The reference model's profile or the .csv file is loaded and every net
+    is resolved once, in this process, and then shared with the worker
+    processes.
+
+    Parameters
+    ----------
+    spec : dict
+        The sweep specification; see the module docstring. An "auto" entry
+        of its "nets" is replaced by the net it stands for.
+    processes : int, optional
+        The number of worker processes. The default is the number of CPUs.
+    records : list, optional
+        If given, a `build_record` of the sweep's own work (loading the
+        inputs, resolving the nets, and hashing) and one of every build are
+        appended to it.
+    profile_dir : str, optional
+        Where to save a cProfile and tracemalloc report of every build; see
+        `build_record`. Only used with `records`.
+
+    Returns
+    -------
+    list of (str, float, bool)
+        The name of each file written, the time it took to build in seconds,
+        and whether it came from the build cache, in grid order.
+    """
+    timings = records is not None
+    with build_record('sweep_setup', profile_dir) if timings else nullcontext() as record:
+        prepared = prepare_sweep(spec)
+    if timings:
+        records.append(record)
+
+    points = prepared[3]
+    processes = processes or cpu_count()
+    # hand out points in batches to keep inter-process traffic low
+    chunksize = max(1, len(points) // (4 * processes))
+    with build_pool(prepared, processes, timings, profile_dir) as executor:
+        results = list(executor.map(build_point, points, chunksize=chunksize))
+    if spec.get('cache', True):
+        evict()
+    if timings:
+        records.extend(record for _, _, _, record in results)
+    return [result[:3] for result in results]
+
+def prepare_sweep(spec):
+    """Load the inputs of a sweep and list its grid points.
+
+    Returns the mode ('modular' or 'manual'), the reference profile or .csv
+    table, the isotopes of each net, and the grid points with their cache
+    keys (see `build_point`).
+    """
+    if 'model' in spec:
+        from modular_composition import reference_profile
+        from profile_reader import read_profile
+        mode = 'modular'
+        model = read_profile(spec['model'])
+        source = reference_profile(model)
+        default_net = model.header('net_name')
+    elif 'csv' in spec:
+        from manual_composition import read_csv_table
+        mode = 'manual'
+        source = read_csv_table(spec['csv'])
+        if 'xq' not in source[0]:
+            raise ValueError("CSV must have an 'xq' column")
+        if not spec.get('nets'):
+            raise ValueError("A manual sweep must list its nets")
+        default_net = None
+    else:
+        raise ValueError("A sweep needs either a 'model' or a 'csv'")
+
+    if 'auto' in (spec.get('nets') or []):
+        if mode == 'modular':
+            from modular_composition import auto_net
+            auto = auto_net(source, default_net)[0]
+        else:
+            auto = resolve_net('auto', [iso for iso in source[0] if iso != 'xq'])
+        # resolved in place, so `plot_jobs` sees the same nets
+        spec['nets'] = list(dict.fromkeys(auto if net == 'auto' else net for net in spec['nets']))
+
+    points = grid_points(spec, default_net)
+    isotopes_by_net = {net: isos_from_net(net) for net in {point[1] for point in points}}
+    if spec.get('cache', True):
+        # the input file is hashed once, here, rather than in every worker
+        if mode == 'modular':
+            keys = [modular_key(spec['model'], isotopes_by_net[net], xq_set['sample_xqs'],
+                                xq_set['boundary_xqs'], multiplier=multiplier)
+                    for xq_set, net, multiplier, _, _ in points]
+        else:
+            keys = [manual_key(spec['csv'], isotopes_by_net[net], multiplier) for _, net, multiplier, _, _ in points]
+    else:
+        keys = [None] * len(points)
+    points = [point + (key,) for point, key in zip(points, keys)]
+    makedirs(spec.get('output_dir', 'compositions'), exist_ok=True)
+    return mode, source, isotopes_by_net, points
+
+def build_pool(prepared, processes=None, timings=False, profile_dir=None):
+    """Return a process pool that builds the grid points of a sweep.
+
+    Parameters
+    ----------
+    prepared : tuple
+        As returned by `prepare_sweep`. The inputs are sent to each worker
+        once, when it starts.
+    processes : int, optional
+        The number of worker processes. The default is the number of CPUs.
+    timings, profile_dir : optional
+        Whether `build_point` returns a `build_record` of each build, and
+        where to save a cProfile and tracemalloc report of each.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+        Submit `build_point` with a grid point to it.
+    """
+    mode, source, isotopes_by_net, _ = prepared
+    return ProcessPoolExecutor(processes or cpu_count(), initializer=_init_worker,
+                               initargs=(mode, source, isotopes_by_net, timings, profile_dir))
+
+def plot_jobs(spec, filenames):
+    """Return the `plotting.plot_batch` jobs that plot a sweep's files.
+
+    Each composition is drawn over the reference model, if there is one,
+    with its sample and boundary locations, and saved next to it as a .pdf.
+
+    Parameters
+    ----------
+    spec : dict
+        The sweep specification; see the module docstring.
+    filenames : list of str
+        The files written for the grid points, in grid order.
+
+    Returns
+    -------
+    list of dict
+        One job per file.
+    """
+    default_net = None
+    if 'model' in spec:
+        from profile_reader import read_profile
+        default_net = read_profile(spec['model']).header('net_name')
+    jobs = []
+    for (xq_set, net, _, _, _), filename in zip(grid_points(spec, default_net), filenames):
+        job = {'filename': filename.rsplit('.', 1)[0] + '.pdf', 'composition': filename, 'net': net}
+        if xq_set is not None:
+            job.update(model=spec['model'], sample_xqs=xq_set['sample_xqs'], boundary_xqs=xq_set['boundary_xqs'])
+        jobs.append(job)
+    return jobs
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build a grid of composition files in parallel.")
+    parser.add_argument('spec', help="JSON file describing the grid")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--validate', action='store_true',
+                        help="check the files written with composition_file.validate_files")
+    parser.add_argument('--plot', action='store_true',
+                        help="save a plot of each composition, over the reference model, next to it as a .pdf")
+    parser.add_argument('--timings', metavar='FILE',
+                        help="append the time and memory each stage of each build took to this JSON Lines file, "
+                             "and print a summary")
+    parser.add_argument('--profile', metavar='DIR',
+                        help="with --timings, also save a cProfile and tracemalloc report of each build here")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    start = time.perf_counter()
+    records = [] if args.timings else None
+    results = run_sweep(spec, args.processes, records, args.profile)
+    elapsed = time.perf_counter() - start
+    build_time = sum(seconds for _, seconds, _ in results)
+    reused = sum(cached for _, _, cached in results)
+    print(f"Built {len(results)} composition files in {elapsed:.2f} s "
+          f"({len(results) / elapsed:.1f} per second, {build_time / max(len(results), 1) * 1e3:.1f} ms per build "
+          f"with {args.processes or cpu_count()} processes; {reused} reused from the cache).")
+    if args.timings:
+        from instrument import append_records, format_summary
+        append_records(args.timings, records)
+        print(format_summary(records))
+        print(f"Appended {len(records)} timing records to {args.timings}")
+    if args.plot:
+        from plotting import plot_batch
+        start = time.perf_counter()
+        plots = plot_batch(plot_jobs(spec, [filename for filename, _, _ in results]), args.processes)
+        print(f"Saved {len(plots)} plots in {time.perf_counter() - start:.2f} s.")
+    if args.validate:
+        from composition_file import validate_files
+        failed = [(filename, problems) for filename, problems in
+                  validate_files([filename for filename, _, _ in results], processes=args.processes) if problems]
+        for filename, problems in failed:
+            print(f"{filename}: {'; '.join(problems)}")
+        print(f"{len(results) - len(failed)} of {len(results)} files passed validation.")
+        if failed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,298 @@
+#! /usr/bin/env python3
+"""Build composition profiles for wd_builder from the command line.
+
+    python wd_profile_builder.py modular <initial_mass> <model> [<sample_xqs> <boundary_xqs>]
+    python wd_profile_builder.py manual <initial_mass> <csv_file> <network.net>
+    python wd_profile_builder.py ensemble <initial_mass> <model> [<model> ...] --sample-xqs ... --boundary-xqs ...
+    python wd_profile_builder.py list-isos <network.net>
+
+Run with a subcommand and `--help` for its options. Nothing is asked
+interactively when `--non-interactive` is given or when standard input is
+not a terminal, so builds can run under batch schedulers. Modules are only
+imported by the subcommands that need them, so startup stays fast.
+"""
+import argparse
+import sys
+
+def _add_build_options(parser):
+    "Options shared by the subcommands that build a composition."
+    parser.add_argument('--pathname', default=None,
+                        help="directory holding compositions/ and outputs/ (default: the current directory)")
+    parser.add_argument('--inlist', default='inlist_wd_builder',
+                        help="inlist to update with the new composition (default: inlist_wd_builder)")
+    parser.add_argument('--no-inlist', action='store_true', help="do not update any inlist")
+    parser.add_argument('--multiplier', type=float, default=1e-6,
+                        help="relative half-width of the transitions between layers (default: 1e-6)")
+    parser.add_argument('--points', type=int, default=2, help="points per transition (default: 2)")
+    parser.add_argument('--shape', default='linear', choices=['linear', 'tanh', 'erf'],
+                        help="shape of transitions with more than 2 points (default: linear)")
+    parser.add_argument('--non-interactive', action='store_true', help="never prompt for input")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always build, without reusing or caching the result")
+    parser.add_argument('--timings', metavar='FILE',
+                        help="append the time and memory each stage of the build took to this JSON Lines file")
+    parser.add_argument('--profile', metavar='DIR',
+                        help="also run the build under cProfile and tracemalloc and save the results here")
+    parser.add_argument('--plot-isotopes', type=lambda text: [iso.strip() for iso in text.split(',')],
+                        metavar='ISOS', help="comma-separated isotopes to plot with --plot "
+                                             "(default: h1,he4,c12,n14,o16,ne20)")
+
+def _mass(text):
+    "Check that a mass is a number, but keep its text for file names."
+    float(text)
+    return text
+
+def _interactive(args):
+    return not args.non_interactive and sys.stdin.isatty()
+
+def _finish_build(args, write, name, initial_mass, key):
+    """Write a composition with `write(filename)` and point the inlist at it.
+
+    Uses the build cache unless `--no-cache` was given; `key` is the build's
+    cache key. Returns the name of the composition file.
+    """
+    from os.path import abspath, join
+
+    pathname = abspath(args.pathname or '.')
+    output_filename = join(pathname, 'compositions', f'{name}.data')
+    cached = False
+    if args.no_cache:
+        write(output_filename)
+    else:
+        from build_cache import cached_build, evict
+        cached = cached_build(key, output_filename, write)
+        if cached:
+            print("Inputs unchanged; reused the cached composition.")
+        evict()
+    from instrument import annotate
+    annotate(output=output_filename, cached=cached)
+    if not args.no_inlist:
+        from inlist import change_inlist
+        change_inlist(args.inlist, {
+            'initial_mass': float(initial_mass),
+            'relax_composition_filename': output_filename,
+            'save_model_filename': join(pathname, 'outputs', f'{name}.mod'),
+        })
+    print(f"Created composition file {output_filename}.")
+    return output_filename
+
+def _announce_auto_net(net, covers):
+    "Say which net 'auto' picked, given the result of `modular_composition.auto_net`."
+    if covers:
+        print(f"Using {net}, the smallest net that holds every isotope of the reference profile.")
+    else:
+        print(f"No net holds every isotope of the reference profile; using {net}.")
+    return net
+
+def modular(args):
+    from modular_composition import (auto_net, composition_name, modular_blend, parse_float_list,
+                                     reference_profile, resampled_composition)
+    from profile_reader import read_profile
+
+    model = read_profile(args.model)
+    sample_xqs = boundary_xqs = None
+    if args.resample is None:
+        if args.sample_xqs is None or args.boundary_xqs is None:
+            if not _interactive(args):
+                sys.exit("Error: sample_xqs and boundary_xqs are required when not running interactively")
+            args.sample_xqs = input("Enter sample locations as a list of comma-separated floats within brackets: ")
+            args.boundary_xqs = input("Enter boundary locations as a list of comma-separated floats within brackets: ")
+        sample_xqs = parse_float_list(args.sample_xqs)
+        boundary_xqs = parse_float_list(args.boundary_xqs)
+        if len(boundary_xqs) != len(sample_xqs) - 1:
+            sys.exit("Error: boundary_xqs must be exactly 1 element shorter than sample_xqs")
+
+    net = args.net or model.header('net_name')
+    reference = None
+    if net == 'auto':
+        reference = reference_profile(model)
+        net = _announce_auto_net(*auto_net(reference, model.header('net_name')))
+    key = None
+    if not args.no_cache:
+        from build_cache import modular_key
+        from list_isos import isos_from_net
+        key = modular_key(args.model, isos_from_net(net), sample_xqs, boundary_xqs, args.resample,
+                          args.multiplier, args.points, args.shape)
+
+    def write(filename):
+        from composition_blend import make_composition_file
+        nonlocal reference
+        if reference is None:
+            reference = reference_profile(model)
+        if args.resample is not None:
+            blend = resampled_composition(reference, args.resample)
+            print(f"Kept {len(blend)} of {len(reference[0])} zones of {args.model} (tolerance {args.resample:g}).")
+        else:
+            blend = modular_blend(reference, sample_xqs, boundary_xqs, args.multiplier, args.points, args.shape)
+        make_composition_file(blend, net, filename)
+    output_filename = _finish_build(args, write, composition_name(args.initial_mass), args.initial_mass, key)
+    if args.plot:
+        from plotting import plot_files
+        plot_files(args.plot, model=args.model, composition=output_filename, net=net, isotopes=args.plot_isotopes,
+                   sample_xqs=sample_xqs or (), boundary_xqs=boundary_xqs or ())
+        print(f"Plot saved as {args.plot}")
+
+def manual(args):
+    from manual_composition import composition_name, csv_columns, write_manual_composition
+    from list_isos import isos_from_net
+
+    columns = csv_columns(args.csv_file)
+    if 'xq' not in columns:
+        sys.exit("Error: CSV must have an 'xq' column")
+    if args.net == 'auto':
+        from list_isos import resolve_net
+        try:
+            args.net = resolve_net('auto', [iso for iso in columns if iso != 'xq'])
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+        print(f"Using {args.net}, the smallest net that holds every isotope of the CSV file.")
+    network_isos = isos_from_net(args.net)
+
+    key = None
+    if not args.no_cache:
+        from build_cache import manual_key
+        key = manual_key(args.csv_file, network_isos, args.multiplier, args.points, args.shape)
+
+    def write(filename):
+        write_manual_composition(args.csv_file, network_isos, args.net, filename,
+                                 args.multiplier, args.points, args.shape, args.chunk_rows)
+    output_filename = _finish_build(args, write, composition_name(args.initial_mass), args.initial_mass, key)
+    if args.plot:
+        from plotting import plot_files
+        plot_files(args.plot, composition=output_filename, net=args.net, isotopes=args.plot_isotopes)
+        print(f"Plot saved as {args.plot}")
+
+def ensemble(args):
+    from ensemble import ensemble_grid, ensemble_reference, write_envelope
+    from list_isos import isos_from_net
+    from modular_composition import auto_net, composition_name, modular_blend, parse_float_list
+
+    sample_xqs = parse_float_list(args.sample_xqs)
+    boundary_xqs = parse_float_list(args.boundary_xqs)
+    if len(boundary_xqs) != len(sample_xqs) - 1:
+        sys.exit("Error: boundary_xqs must be exactly 1 element shorter than sample_xqs")
+    grid = ensemble_grid(args.grid_points, args.xq_min)
+
+    combined = []
+    def reference():
+        "Combine the models, once."
+        if not combined:
+            result = ensemble_reference(args.models, grid, args.statistic, args.percentiles, args.threads)
+            if args.net is None and len(set(result[2])) > 1:
+                sys.exit(f"Error: the models use different nets ({', '.join(sorted(set(result[2])))}); "
+                         "choose one with --net")
+            combined.extend(result)
+        return combined
+
+    net = args.net
+    if net is None or net == 'auto':
+        from profile_reader import read_profile
+        model_net = read_profile(args.models[0]).header('net_name')
+        net = model_net if net is None else _announce_auto_net(*auto_net(reference()[0], model_net))
+
+    key = None
+    if not args.no_cache:
+        from build_cache import ensemble_key
+        key = ensemble_key(args.models, isos_from_net(net), sample_xqs, boundary_xqs, grid, args.statistic,
+                           args.multiplier, args.points, args.shape)
+
+    def write(filename):
+        from composition_blend import make_composition_file
+        blend = modular_blend(reference()[0], sample_xqs, boundary_xqs, args.multiplier, args.points, args.shape)
+        make_composition_file(blend, net, filename)
+    name = f'{composition_name(args.initial_mass)}_ensemble'
+    output_filename = _finish_build(args, write, name, args.initial_mass, key)
+    if args.envelope:
+        combined_reference, envelopes, _ = reference()
+        write_envelope(args.envelope, combined_reference, envelopes, sample_xqs)
+        print(f"Saved the {args.statistic} and percentiles at the sample locations to {args.envelope}")
+    if args.plot:
+        from composition_file import read_composition
+        from plotting import plot_composition
+        xqs, isos, block = reference()[0]
+        comp_xq, matrix, net_isos = read_composition(output_filename, net)
+        plot_composition(args.plot, xqs, dict(zip(isos, block.T)), isotopes=args.plot_isotopes,
+                         sample_xqs=sample_xqs, boundary_xqs=boundary_xqs,
+                         overlay=(comp_xq, dict(zip(net_isos, matrix.T))))
+        print(f"Plot saved as {args.plot}")
+
+def list_isos(args):
+    from list_isos import isos_from_net
+    for i, iso in enumerate(isos_from_net(args.net)):
+        print(i + 1, iso)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Build composition profiles for wd_builder.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_modular = subparsers.add_parser('modular', help="sample the composition of a reference MESA model")
+    parser_modular.add_argument('initial_mass', type=_mass)
+    parser_modular.add_argument('model', help="the reference MESA profile")
+    parser_modular.add_argument('sample_xqs', nargs='?', help="bracketed list of comma-separated floats")
+    parser_modular.add_argument('boundary_xqs', nargs='?', help="bracketed list of comma-separated floats")
+    parser_modular.add_argument('--resample', type=float, metavar='TOLERANCE',
+                                help="keep the whole profile, to within this abundance tolerance, "
+                                     "instead of sampling layers")
+    parser_modular.add_argument('--net', help="the net to write the composition for (default: the model's "
+                                               "net; 'auto' picks the smallest net that holds its isotopes)")
+    parser_modular.add_argument('--plot', metavar='FILE',
+                                help="save a plot of the model's composition, the sample locations, "
+                                     "and the blended composition")
+    _add_build_options(parser_modular)
+    parser_modular.set_defaults(run=modular)
+
+    parser_manual = subparsers.add_parser('manual', help="blend the layers listed in a CSV file")
+    parser_manual.add_argument('initial_mass', type=_mass)
+    parser_manual.add_argument('csv_file')
+    parser_manual.add_argument('net', help="the nuclear network, like co_burn.net, or 'auto' for the smallest "
+                                           "net that holds the CSV file's isotopes")
+    parser_manual.add_argument('--plot', metavar='FILE', help="save a plot of the blended composition")
+    parser_manual.add_argument('--chunk-rows', type=int, default=1 << 16,
+                               help="CSV rows read and blended at a time (default: 65536)")
+    _add_build_options(parser_manual)
+    parser_manual.set_defaults(run=manual)
+
+    parser_ensemble = subparsers.add_parser('ensemble', help="sample the combined composition of many MESA models")
+    parser_ensemble.add_argument('initial_mass', type=_mass)
+    parser_ensemble.add_argument('models', nargs='+', help="the reference MESA profiles")
+    parser_ensemble.add_argument('--sample-xqs', required=True, help="bracketed list of comma-separated floats")
+    parser_ensemble.add_argument('--boundary-xqs', required=True, help="bracketed list of comma-separated floats")
+    parser_ensemble.add_argument('--statistic', default='median', choices=['median', 'mean'],
+                                 help="how to combine the models (default: median)")
+    parser_ensemble.add_argument('--percentiles', default=[16.0, 84.0],
+                                 type=lambda text: [float(value) for value in text.split(',')],
+                                 help="comma-separated percentiles for --envelope (default: 16,84)")
+    parser_ensemble.add_argument('--envelope', metavar='FILE',
+                                 help="save the combined composition and its percentiles at the sample "
+                                      "locations as CSV")
+    parser_ensemble.add_argument('--grid-points', type=int, default=4000,
+                                 help="points of the shared log xq grid (default: 4000)")
+    parser_ensemble.add_argument('--xq-min', type=float, default=1e-12,
+                                 help="smallest xq of the shared grid (default: 1e-12)")
+    parser_ensemble.add_argument('--threads', type=int, default=None,
+                                 help="models read at a time (default: number of CPUs)")
+    parser_ensemble.add_argument('--net', help="the net to write the composition for (default: the models' "
+                                                "net; 'auto' picks the smallest net that holds their isotopes)")
+    parser_ensemble.add_argument('--plot', metavar='FILE',
+                                 help="save a plot of the combined composition and the blended composition")
+    _add_build_options(parser_ensemble)
+    parser_ensemble.set_defaults(run=ensemble)
+
+    parser_list = subparsers.add_parser('list-isos', help="list the isotopes in a nuclear network")
+    parser_list.add_argument('net')
+    parser_list.set_defaults(run=list_isos)
+
+    args = parser.parse_args(argv[1:])
+    if getattr(args, 'timings', None) or getattr(args, 'profile', None):
+        from instrument import append_records, build_record, format_summary
+        with build_record(f'{args.command}_{args.initial_mass}', args.profile, command=args.command) as record:
+            args.run(args)
+        print(format_summary([record]))
+        if args.timings:
+            append_records(args.timings, [record])
+            print(f"Appended the timings to {args.timings}")
+    else:
+        args.run(args)
+
+if __name__ == "__main__":
+    main(sys.argv)